@@ -1,16 +1,40 @@
 from __future__ import print_function
 import csv
+import hashlib
+import heapq
+import ipaddress
 import json
+import os
 import requests  # version: 2.28.1
 import sys
+import time
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                wait, FIRST_COMPLETED)
 import slenv
 
 CERTFILE="./certfile"
-
-def api_request(URL, key, body=None):
-    """ Creates and makes a post request to an SP
+# The most API requests that are made at the same time
+MAX_WORKERS = 8
+# How many times to try a request that failed because of the network or
+# because the leader was busy
+RETRIES = 3
+# Where the outcome for each row of the CSV file is written
+RESULTS_FILE = 'main-results.csv'
+# Where the hash of each managed object's request body is kept between runs
+STATE_FILE = 'main-state.json'
+# How many prefixes each process parses at a time when validating
+VALIDATE_CHUNK_SIZE = 1000
+# The match types of managed objects that match CIDR blocks
+CIDR_MATCH_TYPES = ('cidr_block', 'cidr_v6_block')
+
+def api_request(URL, key, body=None, method='POST'):
+    """ Creates and makes a request to an SP
     api service
 
+    Requests that fail because of a network error or
+    a 429 or 5xx response are tried again, up to
+    RETRIES times, waiting a little longer each time.
+
     Args:
         URL: A URL including an SP leader and
              SP resource
@@ -18,6 +42,7 @@ def api_request(URL, key, body=None):
              SP leader
         body: JSON formatted string to be supplied
               as the request's body
+        method: the HTTP method to use
 
     Returns:
         'data' value of an SP api response
@@ -28,12 +53,25 @@ def api_request(URL, key, body=None):
         'Content-Type': 'application/vnd.api+json'
     }
 
-    api_response = requests.post(
-        URL,
-        data=body,
-        headers=headers,
-        verify=CERTFILE
-    )
+    for attempt in range(1, RETRIES + 1):
+        try:
+            api_response = requests.request(
+                method,
+                URL,
+                data=body,
+                headers=headers,
+                verify=CERTFILE
+            )
+        except requests.exceptions.RequestException as err:
+            if attempt == RETRIES:
+                print('Request failed: {}'.format(err), file=sys.stderr)
+                return {'errors': [{'detail': str(err)}]}
+        else:
+            if (api_response.status_code != requests.codes.too_many_requests
+                    and api_response.status_code < 500
+                    or attempt == RETRIES):
+                break
+        time.sleep(2 ** attempt)
 
     try:
         api_response.raise_for_status()
@@ -53,6 +91,43 @@ def api_request(URL, key, body=None):
         return {}
 
 
+def get_existing_managed_objects(leader, key):
+    """ Get all of the managed objects on the leader,
+    following the "next" links page by page
+
+    Args:
+        leader: hostname of an SP leader
+        key: api key, as generated by the
+             SP leader
+
+    Returns:
+        dict of managed objects, indexed by name
+    """
+
+    url = 'https://{}/api/sp/managed_objects/?perPage=50'.format(leader)
+    managed_objects = {}
+    while url:
+        api_response = requests.get(
+            url,
+            headers={'X-Arbux-APIToken': key,
+                     'Content-Type': 'application/vnd.api+json'},
+            verify=CERTFILE
+        )
+        if api_response.status_code != requests.codes.ok:
+            print(
+                'Could not get the existing managed objects: {}'.format(
+                    api_response.text),
+                file=sys.stderr
+            )
+            sys.exit(1)
+        page = api_response.json()
+        for managed_object in page['data']:
+            managed_objects[managed_object['attributes']['name']] = \
+                managed_object
+        url = page.get('links', {}).get('next')
+    return managed_objects
+
+
 def get_request_body(managed_object):
     """Map a row in a csv to a nested dictionary
     that SP will accept as a managed object
@@ -70,10 +145,10 @@ def get_request_body(managed_object):
     return {
         'data': {
             'attributes': {
-                'name': managed_object['name'],
+                'name': managed_object['name'].strip(),
                 'family': 'customer',
                 'match_type': 'cidr_block',
-                'match': managed_object['prefix'],
+                'match': ' '.join(managed_object['prefix'].split()),
                 'tags': ['api', 'customer']
             },
             'relationships': {
@@ -88,6 +163,60 @@ def get_request_body(managed_object):
     }
 
 
+def request_body_hash(managed_object):
+    """ Hash the request body for a managed object, so
+    a row that hasn't changed since the last run can
+    be recognized without asking the leader
+
+    Args:
+        managed_object: nested dict representing
+                        a managed object
+
+    Returns:
+        hex string of the SHA-256 hash of the body
+        with its keys sorted and its tags in order
+    """
+
+    body = json.loads(json.dumps(managed_object))
+    body['data']['attributes']['tags'] = sorted(
+        body['data']['attributes'].get('tags', []))
+    return hashlib.sha256(json.dumps(
+        body, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def load_state(filename=STATE_FILE):
+    """ Load the hash and Id of each managed object
+    provisioned by earlier runs
+
+    Args:
+        filename: path / name of the state file
+
+    Returns:
+        dict of {'hash': ..., 'id': ...} dicts,
+        indexed by managed object name
+    """
+
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as state_file:
+        return json.load(state_file)
+
+
+def save_state(state, filename=STATE_FILE):
+    """ Write the state file, replacing the old one
+    only once the new one is complete
+
+    Args:
+        state: dict from load_state(), as updated by
+               provision_managed_objects()
+        filename: path / name of the state file
+    """
+
+    with open(filename + '.tmp', 'w') as state_file:
+        json.dump(state, state_file, indent=1, sort_keys=True)
+    os.rename(filename + '.tmp', filename)
+
+
 def get_managed_objects_from_csv(filename):
     """ Get a handler for managed object data
     from a csv file
@@ -110,6 +239,202 @@ def get_managed_objects_from_csv(filename):
             yield get_request_body(row)
 
 
+def parse_prefixes(rows):
+    """ Turn the prefixes of some managed objects into
+    ranges of integer addresses
+
+    This runs in a separate process, so it only gets
+    and returns plain tuples.
+
+    Args:
+        rows: list of (source, name, match) tuples,
+              where match is one or more prefixes
+              separated by spaces and source says
+              where the row came from
+
+    Returns:
+        tuple of a list of (version, first, last,
+        prefix, source, name) ranges and a list of
+        error messages for prefixes that can't be
+        parsed
+    """
+
+    ranges = []
+    errors = []
+    for source, name, match in rows:
+        prefixes = match.split()
+        if not prefixes:
+            errors.append('{}: {} has no prefix'.format(source, name))
+        for prefix in prefixes:
+            try:
+                network = ipaddress.ip_network(prefix, strict=False)
+            except ValueError as err:
+                errors.append('{}: {} has a bad prefix: {}'.format(
+                    source, name, err))
+                continue
+            ranges.append((network.version,
+                           int(network.network_address),
+                           int(network.broadcast_address),
+                           prefix, source, name))
+    return ranges, errors
+
+
+def overlapping_prefixes(ranges):
+    """ Find the pairs of ranges that overlap
+
+    The ranges are sorted by their first address and
+    swept in order, keeping a heap of the ranges that
+    haven't ended yet, so each range is only compared
+    with the ranges it actually overlaps.
+
+    Args:
+        ranges: list of ranges from parse_prefixes()
+
+    Returns:
+        generator of (earlier range, later range)
+        tuples that overlap
+    """
+
+    active = []
+    version = None
+    for interval in sorted(ranges, key=lambda r: (r[0], r[1], -r[2])):
+        if interval[0] != version:
+            version = interval[0]
+            active = []
+        while active and active[0][0] < interval[1]:
+            heapq.heappop(active)
+        for _, _, other in active:
+            yield other, interval
+        heapq.heappush(active, (interval[2], id(interval), interval))
+
+
+def validate_managed_objects(filename, existing, removed=(),
+                             workers=None):
+    """ Check the prefixes in a csv file before
+    anything is written to the leader
+
+    The prefixes in the file and the match values of
+    the existing CIDR managed objects are parsed by a
+    pool of processes, then every prefix in the file
+    is checked against every other one and against
+    the existing managed objects.  An existing
+    managed object with the same name as a row is
+    the one the row will update, and one that is
+    about to be deleted can't clash with anything,
+    so they aren't compared.
+
+    Args:
+        filename: path / name for a csv file
+                  containing managed object
+                  configurations
+        existing: dict of the managed objects on the
+                  leader, indexed by name
+        removed: names of the managed objects that
+                 will be deleted because their rows
+                 are no longer in the csv
+        workers: the most processes to use
+
+    Returns:
+        list of error messages, empty if the file
+        can be provisioned
+    """
+
+    rows = [('line {}'.format(line), managed_object['data']['attributes']
+             ['name'], managed_object['data']['attributes']['match'])
+            for line, managed_object in enumerate(
+                get_managed_objects_from_csv(filename), 2)]
+    rows += [('managed object', name, mo['attributes'].get('match', ''))
+             for name, mo in existing.items()
+             if mo['attributes'].get('match_type') in CIDR_MATCH_TYPES and
+             name not in removed]
+
+    ranges = []
+    errors = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for chunk_ranges, chunk_errors in pool.map(
+                parse_prefixes,
+                [rows[i:i + VALIDATE_CHUNK_SIZE]
+                 for i in range(0, len(rows), VALIDATE_CHUNK_SIZE)]):
+            ranges.extend(chunk_ranges)
+            errors.extend(chunk_errors)
+
+    for first, second in overlapping_prefixes(ranges):
+        if first[4] == second[4] == 'managed object':
+            continue
+        if 'managed object' in (first[4], second[4]) and \
+                first[5] == second[5]:
+            continue
+        errors.append('{}: {} {} {} {}: {} {}'.format(
+            second[4], second[5], second[3],
+            'duplicates' if first[1:3] == second[1:3] else 'overlaps',
+            first[4], first[5], first[3]))
+    return errors
+
+
+def compare_with_state(filename, state):
+    """ Find out, without asking the leader, whether a
+    csv file changes anything since the last run
+
+    Args:
+        filename: path / name for a csv file
+                  containing managed object
+                  configurations
+        state: dict from load_state()
+
+    Returns:
+        tuple of whether any row's request body hash
+        differs from the state and the set of names
+        in the state that are no longer in the file
+    """
+
+    changed = False
+    names = set()
+    for managed_object in get_managed_objects_from_csv(filename):
+        name = managed_object['data']['attributes']['name']
+        names.add(name)
+        known = state.get(name)
+        if not known or known['hash'] != request_body_hash(managed_object):
+            changed = True
+    return changed, set(state) - names
+
+
+def changed_fields(existing, managed_object):
+    """ Find what a managed object from the csv would
+    change about one that already exists
+
+    Args:
+        existing: the managed object as returned by
+                  the managed_objects endpoint
+        managed_object: nested dict representing
+                        the managed object wanted
+
+    Returns:
+        A nested dict with only the attributes and
+        relationships that differ, empty if nothing
+        differs
+    """
+
+    wanted = managed_object['data']
+    attributes = {
+        name: value
+        for name, value in wanted['attributes'].items()
+        if existing['attributes'].get(name) != value
+    }
+    relationships = {
+        name: value
+        for name, value in wanted['relationships'].items()
+        if existing.get('relationships', {}).get(name, {}).get('data')
+        != value['data']
+    }
+
+    changes = {}
+    if attributes:
+        changes['attributes'] = attributes
+    if relationships:
+        changes['relationships'] = relationships
+    return changes
+
+
 def create_managed_object(leader, key, managed_object):
     """ Crafts and makes an api request to create
     an SP managed object
@@ -145,6 +470,216 @@ def create_managed_object(leader, key, managed_object):
     return response["id"]
 
 
+def update_managed_object(leader, key, mo_id, changes):
+    """ Crafts and makes an api request to change
+    some attributes of an SP managed object
+
+    Args:
+        leader: hostname of an SP leader
+        key: api key, as generated by the
+             SP leader
+        mo_id: the ID of the managed object
+        changes: nested dict with the attributes and
+                 relationships to change, from
+                 changed_fields()
+
+    Returns:
+        Id as string of the managed object, or
+        None if request was unsuccessful
+    """
+
+    response = api_request(
+        'https://{}/api/sp/managed_objects/{}'.format(leader, mo_id),
+        key,
+        json.dumps({'data': changes}),
+        method='PATCH'
+    )
+
+    if 'errors' in response:
+        print(
+            'Could not update managed object {}...'.format(mo_id),
+            file=sys.stderr
+        )
+        return None
+
+    return response["id"]
+
+
+def delete_managed_object(leader, key, mo_id):
+    """ Crafts and makes an api request to delete an
+    SP managed object
+
+    Args:
+        leader: hostname of an SP leader
+        key: api key, as generated by the
+             SP leader
+        mo_id: the ID of the managed object
+
+    Returns:
+        boolean indicating the success of the
+        operation
+    """
+
+    response = api_request(
+        'https://{}/api/sp/managed_objects/{}'.format(leader, mo_id),
+        key,
+        method='DELETE'
+    )
+
+    if 'errors' in response:
+        print(
+            'Could not delete managed object {}...'.format(mo_id),
+            file=sys.stderr
+        )
+        return False
+
+    return True
+
+
+def provision_managed_object(leader, key, existing, managed_object):
+    """ Create a managed object, update it if it
+    exists and differs, or leave it alone
+
+    Args:
+        leader: hostname of an SP leader
+        key: api key, as generated by the
+             SP leader
+        existing: dict of the managed objects on the
+                  leader, indexed by name
+        managed_object: nested dict representing
+                        the managed object wanted
+
+    Returns:
+        tuple of the action taken ('created',
+        'updated', 'unchanged', or 'failed') and the
+        Id of the managed object
+    """
+
+    name = managed_object['data']['attributes']['name']
+    if name not in existing:
+        mo_id = create_managed_object(leader, key, managed_object)
+        return ('created' if mo_id else 'failed'), mo_id
+
+    mo_id = existing[name]['id']
+    changes = changed_fields(existing[name], managed_object)
+    if not changes:
+        return 'unchanged', mo_id
+    if update_managed_object(leader, key, mo_id, changes) is None:
+        return 'failed', mo_id
+    return 'updated', mo_id
+
+
+def provision_managed_objects(leader, key, managed_objects, state=None,
+                              existing=None, results_file=RESULTS_FILE,
+                              workers=MAX_WORKERS):
+    """ Provision managed objects from a generator,
+    several at the same time
+
+    The existing managed objects are fetched once,
+    and no more than `workers` rows are read from the
+    generator ahead of the requests that are running,
+    so a large csv file is never held in memory.  A
+    name that appears again later in the csv is
+    skipped, so two requests never race to create
+    the same managed object.
+
+    When `state` is given, a row whose request body
+    hashes the same as it did on the last run is
+    counted as unchanged without any API request, the
+    existing managed objects are only fetched if some
+    row did change, and managed objects in the state
+    that are no longer in the csv are deleted.  The
+    state is updated in place.
+
+    Args:
+        leader: hostname of an SP leader
+        key: api key, as generated by the
+             SP leader
+        managed_objects: iterable of nested dicts
+                         representing managed objects
+        results_file: path / name of the csv file
+                      the outcome of each row is
+                      written to
+        state: dict from load_state(), or None to
+               check every row against the leader
+        existing: dict of the managed objects on the
+                  leader, indexed by name, if they
+                  have already been fetched
+        workers: the most requests made at the
+                 same time
+
+    Returns:
+        dict counting each action taken
+    """
+
+    counts = {}
+    seen = set()
+
+    with open(results_file, 'w') as results, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        writer = csv.writer(results)
+        writer.writerow(['name', 'prefix', 'action', 'id'])
+
+        def record(name, prefix, action, mo_id, body_hash=None):
+            counts[action] = counts.get(action, 0) + 1
+            writer.writerow([name, prefix, action, mo_id or ''])
+            if state is None:
+                return
+            if action == 'failed':
+                # forget the old hash so the row is tried again next time
+                if body_hash and name in state:
+                    state[name]['hash'] = None
+            elif action == 'deleted':
+                del state[name]
+            elif body_hash:
+                state[name] = {'hash': body_hash, 'id': mo_id}
+
+        running = {}
+
+        def finish(done):
+            for future in done:
+                name, prefix, body_hash = running.pop(future)
+                record(name, prefix, *future.result(), body_hash=body_hash)
+
+        for managed_object in managed_objects:
+            attributes = managed_object['data']['attributes']
+            if attributes['name'] in seen:
+                record(attributes['name'], attributes['match'],
+                       'duplicate', None)
+                continue
+            seen.add(attributes['name'])
+
+            body_hash = None
+            if state is not None:
+                body_hash = request_body_hash(managed_object)
+                known = state.get(attributes['name'])
+                if known and known['hash'] == body_hash:
+                    record(attributes['name'], attributes['match'],
+                           'unchanged', known['id'])
+                    continue
+            if existing is None:
+                existing = get_existing_managed_objects(leader, key)
+
+            if len(running) >= workers:
+                finish(wait(running, return_when=FIRST_COMPLETED).done)
+            future = pool.submit(provision_managed_object, leader, key,
+                                 existing, managed_object)
+            running[future] = (attributes['name'], attributes['match'],
+                               body_hash)
+        finish(wait(running).done)
+
+        if state is not None:
+            vanished = {pool.submit(delete_managed_object, leader, key,
+                                    state[name]['id']): name
+                        for name in state if name not in seen}
+            for future in wait(vanished).done:
+                name = vanished[future]
+                record(name, '', 'deleted' if future.result() else
+                       'failed', state[name]['id'])
+
+    return counts
+
+
 def commit_config(leader, key):
     """ Crafts and makes an api request to commit an
         SP configuration
@@ -162,7 +697,7 @@ def commit_config(leader, key):
         'data': {
             'attributes': {
                 'commit_log_message':
-                    'Added managed objects to deployment via SP API'
+                    'Synchronized managed objects with main.csv via SP API'
             }
         }
     })
@@ -188,10 +723,37 @@ def main():
     LEADER = slenv.leader
     KEY = slenv.apitoken
 
-    for listing in get_managed_objects_from_csv('main.csv'):
-        create_managed_object(LEADER, KEY, listing)
-
-    commit_config(LEADER, KEY)
+    start = time.time()
+    state = load_state()
+
+    # only fetch and check the managed objects if a row changed or was
+    # removed, so an unchanged csv file costs no requests
+    existing = None
+    changed, removed = compare_with_state('main.csv', state)
+    if changed or removed:
+        existing = get_existing_managed_objects(LEADER, KEY)
+        errors = validate_managed_objects('main.csv', existing, removed)
+        if errors:
+            for error in errors:
+                print(error, file=sys.stderr)
+            print('main.csv has {} problem(s); nothing was changed'.format(
+                len(errors)), file=sys.stderr)
+            sys.exit(1)
+
+    counts = provision_managed_objects(
+        LEADER, KEY, get_managed_objects_from_csv('main.csv'), state,
+        existing)
+    save_state(state)
+    print('{} in {:.1f} seconds; see {} for each row'.format(
+        ', '.join('{} {}'.format(number, action)
+                  for action, number in sorted(counts.items())) or
+        'No managed objects',
+        time.time() - start, RESULTS_FILE))
+
+    # commits are expensive on the leader, so only commit real changes
+    if any(counts.get(action) for action in ('created', 'updated',
+                                              'deleted')):
+        commit_config(LEADER, KEY)
 
 
 if __name__ == "__main__":
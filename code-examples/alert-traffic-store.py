@@ -0,0 +1,312 @@
+from __future__ import print_function
+from sys import stderr
+import argparse
+import json
+import os
+import requests  # version 2.28.1
+import arrow  # version 1.2.3
+import numpy as np  # version 1.23.3
+import slenv
+
+CERT_FILE = './certfile'
+STORE_DIR = './alert-traffic-store'
+DATA_FILE = 'timeseries.bin'
+INDEX_FILE = 'index.json'
+# The API returns whole numbers of bps and pps, so they are stored
+# exactly as 8-byte integers
+DTYPE = np.int64
+UNITS = ['bps', 'pps']
+ENDPOINTS = {
+    'router': '/api/sp/alerts/{}/router_traffic/',
+    'prefix': '/api/sp/alerts/{}/traffic/dest_prefixes/'
+}
+
+
+class TimeseriesStore(object):
+    """Alert traffic timeseries kept in one memory-mapped file.
+
+    Every series is described by a small metadata record (alert ID,
+    kind, router or prefix name, unit, timeseries start, step) and
+    the values themselves are appended to one contiguous file of
+    integers.  Reading a series maps that file into memory and returns
+    a view of it, so slicing a series by time never copies the data and
+    thousands of alerts can be analyzed without building a Python object
+    per data point.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data_path = os.path.join(path, DATA_FILE)
+        self.index_path = os.path.join(path, INDEX_FILE)
+        self.index = []
+        self._data = None
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        self._free = self._unused_space()
+
+    def add(self, alert_id, kind, name, unit, timeseries_start, step,
+            timeseries):
+        """Append one timeseries to the store.
+
+        A series that is already stored for the same alert, kind, name
+        and unit is replaced, so an alert can be ingested again to
+        update it.  The values go in space that the saved index doesn't
+        use if there is enough of it, and are appended otherwise; the
+        space of a replaced series is only reused after save(), so if a
+        run stops part way the saved index still matches the data.
+
+        Args:
+            alert_id: the ID of the alert the series belongs to
+            kind: 'router' or 'prefix'
+            name: the router view name or prefix of the series
+            unit: 'bps' or 'pps'
+            timeseries_start: the ISO 8601 start time of the series
+            step: the number of seconds each value spans
+            timeseries: the list of values from the API
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        values = np.asarray(timeseries, dtype=DTYPE)
+        old = self.find(alert_id, kind, name, unit)
+        # Drop the memory map before the file underneath it changes
+        self._data = None
+        free = [i for i, (_, length) in enumerate(self._free)
+                if length >= len(values)]
+        if free:
+            offset, length = self._free[free[0]]
+            self._free[free[0]] = (offset + len(values),
+                                   length - len(values))
+            with open(self.data_path, 'r+b') as f:
+                f.seek(offset * values.itemsize)
+                values.tofile(f)
+        else:
+            with open(self.data_path, 'ab') as f:
+                offset = f.tell() // values.itemsize
+                values.tofile(f)
+        self.index = [record for record in self.index if record not in old]
+        self.index.append({
+            'alert_id': str(alert_id),
+            'kind': kind,
+            'name': name,
+            'unit': unit,
+            'timeseries_start': arrow.get(timeseries_start).int_timestamp,
+            'step': step,
+            'offset': offset,
+            'length': len(values)
+        })
+
+    def save(self):
+        """Write the metadata index next to the data file.
+
+        The old index is only replaced once the new one is complete,
+        and the space of the series it no longer lists can then be
+        reused.
+        """
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.rename(self.index_path + '.tmp', self.index_path)
+        self._free = self._unused_space()
+
+    def _unused_space(self):
+        """List the (offset, length) gaps in the data file not indexed."""
+        size = 0
+        if os.path.exists(self.data_path):
+            size = os.path.getsize(self.data_path) // np.dtype(DTYPE).itemsize
+        gaps = []
+        position = 0
+        for record in sorted(self.index, key=lambda r: r['offset']):
+            if record['offset'] > position:
+                gaps.append((position, record['offset'] - position))
+            position = max(position, record['offset'] + record['length'])
+        if size > position:
+            gaps.append((position, size - position))
+        return gaps
+
+    def find(self, alert_id=None, kind=None, name=None, unit=None):
+        """Return the metadata records that match all of the arguments."""
+        wanted = {'alert_id': None if alert_id is None else str(alert_id),
+                  'kind': kind, 'name': name, 'unit': unit}
+        return [record for record in self.index
+                if all(value is None or record[key] == value
+                       for key, value in wanted.items())]
+
+    def values(self, record, start=None, end=None):
+        """Return a series, or part of it, without copying it.
+
+        Args:
+            record: a metadata record returned by find()
+            start (optional): arrow-parseable time of the first value
+            end (optional): arrow-parseable time after the last value
+
+        Returns:
+            A read-only numpy view of the values in [start, end)
+        """
+        if self._data is None:
+            self._data = np.memmap(self.data_path, dtype=DTYPE, mode='r')
+        first, last = 0, record['length']
+        if start is not None:
+            first = self._position(record, start)
+        if end is not None:
+            last = self._position(record, end)
+        return self._data[record['offset'] + first:record['offset'] + last]
+
+    @staticmethod
+    def _position(record, when):
+        """Convert a time into an index into a series, clamped to it."""
+        seconds = arrow.get(when).int_timestamp - record['timeseries_start']
+        position = -(-seconds // record['step'])
+        return min(max(position, 0), record['length'])
+
+
+def summarize(values):
+    """Compute the summary values the API reports for a timeseries.
+
+    The results are whole numbers like the API's, and the 95th
+    percentile is the nearest-rank value, so they can be compared with
+    the avg_value, max_value and pct95_value the API returns.
+
+    Args:
+        values: a numpy array of timeseries values
+
+    Returns:
+        A dict with the keys 'avg_value', 'max_value', 'pct95_value'
+    """
+    if len(values) == 0:
+        return {'avg_value': 0, 'max_value': 0, 'pct95_value': 0}
+    rank = int(np.ceil(0.95 * len(values))) - 1
+    return {
+        'avg_value': int(round(values.mean())),
+        'max_value': int(values.max()),
+        'pct95_value': int(np.partition(values, rank)[rank])
+    }
+
+
+def api_get_request(url, api_key):
+    """Build an API GET request.
+
+    Args:
+        url: a valid SP box url to make the request
+        api_key: API token used to access and use the SP API
+
+    Returns:
+        Dict value for 'data' entry of JSON response
+    """
+    api_response = requests.get(
+        url,
+        headers={
+            'X-Arbux-APIToken': api_key,
+            'Content-Type': 'application/vnd.api+json'
+        },
+        verify=CERT_FILE)
+
+    # Handle API error responses
+    if (api_response.status_code < requests.codes.ok or
+            api_response.status_code >= requests.codes.multiple_choices):
+        print("API responded with this error: \n{}".format(api_response.text),
+              file=stderr)
+        return []
+
+    # Convert the response to JSON and return
+    return api_response.json()['data']
+
+
+def ingest_alert(store, sp_leader, api_key, alert_id):
+    """Fetch the router and prefix traffic of an alert into the store.
+
+    Args:
+        store: a TimeseriesStore
+        sp_leader: a valid SP box domain name
+        api_key: API token used to access and use the SP API
+        alert_id: the ID of the alert to store
+
+    Returns:
+        The number of series added and the number whose summary values
+        differ from the ones the API reported
+    """
+    added = mismatched = 0
+    for kind, uri in ENDPOINTS.items():
+        for unit in UNITS:
+            url = "https://{}{}?query_unit={}".format(
+                sp_leader, uri.format(alert_id), unit)
+            for item in api_get_request(url, api_key):
+                for view_name, view in item['attributes']['view'].items():
+                    data = view['unit'].get(unit)
+                    if not data:
+                        continue
+                    name = data.get('name', view_name)
+                    store.add(alert_id, kind, name, unit,
+                              data['timeseries_start'], data['step'],
+                              data['timeseries'])
+                    added += 1
+                    computed = summarize(np.asarray(data['timeseries'],
+                                                    dtype=DTYPE))
+                    if any(key in data and data[key] != value
+                           for key, value in computed.items()):
+                        mismatched += 1
+    return added, mismatched
+
+
+def report(store, alert_id=None, unit=None, start=None, end=None):
+    """Print summary values for the stored series that match."""
+    print("{:>10} {:>7} {:>24} {:>4} {:>14} {:>14} {:>14}".format(
+        'alert', 'kind', 'name', 'unit', 'avg', 'max', 'pct95'))
+    for record in store.find(alert_id=alert_id, unit=unit):
+        summary = summarize(store.values(record, start, end))
+        print("{:>10} {:>7} {:>24} {:>4} {:>14} {:>14} {:>14}".format(
+            record['alert_id'], record['kind'], record['name'],
+            record['unit'], summary['avg_value'], summary['max_value'],
+            summary['pct95_value']))
+
+
+def parse_cmdline_args():
+    """Parse the command line options and set some useful defaults"""
+    parser = argparse.ArgumentParser(
+        description='Store alert traffic timeseries compactly and '
+                    'summarize them',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '-d', '--store_dir',
+        default=STORE_DIR,
+        dest='store_dir',
+        help='Directory holding the timeseries store')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    ingest = subparsers.add_parser(
+        'ingest', help='Fetch alert traffic into the store')
+    ingest.add_argument('alert_ids', nargs='+',
+                        help='IDs of the alerts to store')
+
+    summary = subparsers.add_parser(
+        'report', help='Summarize stored traffic')
+    summary.add_argument('-a', '--alert_id', dest='alert_id',
+                         help='Only report on this alert')
+    summary.add_argument('-u', '--unit', dest='unit', choices=UNITS,
+                         help='Only report on this unit')
+    summary.add_argument('-s', '--start_time', dest='start',
+                         help='Only use values from this time onwards')
+    summary.add_argument('-e', '--end_time', dest='end',
+                         help='Only use values before this time')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_cmdline_args()
+    store = TimeseriesStore(args.store_dir)
+
+    if args.command == 'ingest':
+        for alert_id in args.alert_ids:
+            print("Storing traffic for alert {} ...".format(alert_id))
+            added, mismatched = ingest_alert(store, slenv.leader,
+                                             slenv.apitoken, alert_id)
+            print("  {} series stored".format(added))
+            if mismatched:
+                print("  {} series have summary values that differ from "
+                      "the API's".format(mismatched), file=stderr)
+            # Save after each alert so an interrupted run keeps the
+            # alerts it has finished
+            store.save()
+    else:
+        report(store, args.alert_id, args.unit, args.start, args.end)
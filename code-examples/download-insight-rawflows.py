@@ -2,15 +2,33 @@ from __future__ import print_function
 import argparse
 import requests
 import json
+import os
+import pickle
+import socket
+import struct
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dateutil.parser import parse
+import numpy as np
+
+CHUNK_SIZE = 262144
+# The type each requested dimension is stored as in columnar output
+COLUMN_TYPES = {
+    "IP_Protocol": "uint8",
+    "Source_IPv4_Address": "uint32",
+    "Source_Port": "uint16",
+    "Destination_IPv4_Address": "uint32",
+    "Destination_Port": "uint16"
+}
 
 
 def parse_cmdline_args():
     """Parse the command line options and set some useful defaults"""
     parser = argparse.ArgumentParser(
-        description='Download raw flows from SP Insight to a CSV file',
+        description='Download raw flows from SP Insight to a CSV file '
+                    'or columnar binary files',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument(
         '-s', '--start_time',
@@ -53,15 +71,605 @@ def parse_cmdline_args():
         default='raw_flows.csv',
         dest='output_file',
         help='Path and filename for rawflows CSV data')
+    parser.add_argument(
+        '-T', '--time_dimension',
+        default='Start_Time',
+        dest='time_dimension',
+        help='Time dimension to request with each flow so that '
+             'rawflows-store.py can store the flows by hour; empty to '
+             'leave it out')
+    parser.add_argument(
+        '-t', '--output_format',
+        choices=['csv', 'columnar', 'summary'],
+        default='csv',
+        dest='output_format',
+        help='Write the CSV as it arrives, convert it as it arrives into '
+             'one binary file per dimension next to --output_file, or '
+             'only count protocols, ports and top talkers')
+    parser.add_argument(
+        '-K', '--top',
+        type=int,
+        default=20,
+        dest='top',
+        help='Number of top talkers and ports to report in summary format')
     parser.add_argument(
         '-c', '--cert_file',
         default='/Users/acaird/certfile',
         dest='certfile',
         help='Path to and name of the SSL certificate file')
+    parser.add_argument(
+        '-j', '--shards',
+        type=int,
+        default=1,
+        dest='shards',
+        help='Split the time range into this many windows and download '
+             'them at the same time; each window asks for its share of '
+             'the raw flow records and is saved as a CSV shard file, '
+             'whatever the output format, until it is added to the '
+             'output')
+    parser.add_argument(
+        '-r', '--resume',
+        action='store_true',
+        dest='resume',
+        help='Continue an interrupted download using the manifest next to '
+             'the output file, fetching only the windows that are '
+             'missing')
 
     return parser.parse_args()
 
 
+def build_query(args, start, end, limit):
+    """Build the rawflows query for a time window"""
+    dimensions = [
+        "IP_Protocol",
+        "Source_IPv4_Address",
+        "Source_Port",
+        "Destination_IPv4_Address",
+        "Destination_Port"
+    ]
+    if args.time_dimension:
+        dimensions.append(args.time_dimension)
+    return {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "dimensions": dimensions,
+        "limit": limit,
+        "perspective": args.perspective,
+        "view": args.view
+    }
+
+
+def post_query(args, leaderurl, query):
+    """POST a rawflows query and return the streaming response"""
+    return requests.post(leaderurl,
+                         headers={"X-Arbux-APIToken": args.apikey,
+                                  "Content-Type": "application/vnd.api+json",
+                                  "Accept": "text/csv"},
+                         data=json.dumps(query), verify=args.certfile,
+                         stream=True)
+
+
+def shard_windows(start, end, shards):
+    """Split the time from start to end into equal windows"""
+    width = (end - start) / shards
+    edges = [start + width * i for i in range(shards)] + [end]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def print_times(query_start, query_end, write_end, label=''):
+    """Print the query, write and total time of a download"""
+    print ("{}Query time: {:10.1f} seconds".format(
+        label, ((query_end-query_start).total_seconds())))
+    print ("{}Write time: {:10.1f} seconds".format(
+        label, ((write_end-query_end).total_seconds())))
+    print ("{}Total time: {:10.1f} seconds".format(
+        label, ((write_end-query_start).total_seconds())))
+
+
+def ipv4_to_int(address):
+    """Convert a dotted-quad IPv4 address in bytes to an integer"""
+    try:
+        return struct.unpack("!I", socket.inet_aton(address.decode()))[0]
+    except (OSError, UnicodeDecodeError):
+        return 0
+
+
+class CsvOutput(object):
+    """Write the rawflows CSV to the output file as it arrives"""
+
+    def __init__(self, filename, position=None):
+        self.f = open(filename, "r+b" if position is not None else "wb")
+        # Drop anything written after the last recorded position
+        self.f.seek(position or 0)
+        self.f.truncate()
+
+    def write(self, data):
+        self.f.write(data)
+
+    def position(self):
+        """Return the number of bytes written so far"""
+        self.f.flush()
+        return self.f.tell()
+
+    def close(self):
+        self.f.close()
+
+    def abandon(self):
+        """Stop writing, leaving the output to be continued later"""
+        self.f.close()
+
+
+def to_array(values, dtype):
+    """Convert a list of CSV fields in bytes to a numpy array of dtype"""
+    if dtype == "uint32":
+        return np.fromiter((ipv4_to_int(v) for v in values),
+                           dtype=np.uint32, count=len(values))
+    array = np.array(values)
+    array[array == b""] = b"0"
+    return array.astype(dtype)
+
+
+class RowsOutput(object):
+    """Split the rawflows CSV into rows as it arrives
+
+    Subclasses are given the position of each requested dimension in the
+    CSV header by _start() and lists of rows, each a list of fields in
+    bytes, by _add_rows().
+    """
+
+    def __init__(self):
+        self.header = None
+        self.partial = b""
+        self.rows = 0
+
+    def _start(self):
+        pass
+
+    def _add_rows(self, rows):
+        raise NotImplementedError
+
+    def abandon(self):
+        """Stop writing, keeping what was saved by the last position()"""
+        pass
+
+    def write(self, data):
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        if lines and self.header is None:
+            self.header = self._parse_header(lines.pop(0))
+            self._start()
+        rows = [line.rstrip(b"\r").split(b",") for line in lines if line]
+        if rows:
+            self._add_rows(rows)
+            self.rows += len(rows)
+
+    def _flush_partial(self):
+        """Treat anything after the last newline as a complete row"""
+        if self.partial:
+            self.write(b"\n")
+
+    @staticmethod
+    def _parse_header(header):
+        """Find the requested dimensions in the CSV header
+
+        Returns:
+            A dict of dimension name to its index in each row
+        """
+        names = {name.lower(): name for name in COLUMN_TYPES}
+        found = {}
+        for index, title in enumerate(header.rstrip(b"\r").split(b",")):
+            title = title.decode().strip().strip('"').replace(" ", "_")
+            name = names.get(title.lower())
+            if name is None:
+                print ("  Not using the column {}".format(title))
+                continue
+            found[name] = index
+        return found
+
+
+class ColumnarOutput(RowsOutput):
+    """Convert the rawflows CSV into typed binary columns as it arrives
+
+    Each dimension is written to its own file of fixed-size integers
+    (addresses as uint32, ports as uint16, the protocol as uint8) and a
+    small JSON file records the columns and the number of rows, so the
+    columns can be loaded with load_columnar() without parsing the CSV
+    again.
+    """
+
+    def __init__(self, filename, position=None):
+        super(ColumnarOutput, self).__init__()
+        base = os.path.splitext(filename)[0]
+        self.meta_path = base + ".columns.json"
+        self.base = base
+        self.columns = []
+        if position is not None:
+            # Continue an earlier download from its recorded row count
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            for column in meta["columns"]:
+                f = open(column["file"], "r+b")
+                f.seek(position * np.dtype(column["dtype"]).itemsize)
+                f.truncate()
+                self.columns.append(dict(column, f=f))
+            self.header = {column["name"]: column["index"]
+                           for column in self.columns}
+            self.rows = position
+
+    def _start(self):
+        for name, index in sorted(self.header.items(), key=lambda i: i[1]):
+            filename = "{}.{}.bin".format(self.base, name)
+            self.columns.append({"name": name,
+                                 "index": index,
+                                 "dtype": COLUMN_TYPES[name],
+                                 "file": filename,
+                                 "f": open(filename, "wb")})
+
+    def _add_rows(self, rows):
+        for column in self.columns:
+            values = [row[column["index"]] for row in rows]
+            to_array(values, column["dtype"]).tofile(column["f"])
+
+    def position(self):
+        """Return the number of rows written so far"""
+        self._flush_partial()
+        for column in self.columns:
+            column["f"].flush()
+        with open(self.meta_path, "w") as f:
+            json.dump({"rows": self.rows,
+                       "columns": [{key: column[key] for key in
+                                    ("name", "index", "dtype", "file")}
+                                   for column in self.columns]}, f)
+        return self.rows
+
+    def close(self):
+        self.position()
+        for column in self.columns:
+            column["f"].close()
+
+    def abandon(self):
+        for column in self.columns:
+            column["f"].close()
+
+
+class TopK(object):
+    """Keep approximate counts of the most common keys in bounded memory
+
+    Counts for each batch of keys are merged into at most `capacity`
+    counters; when there are more, the smallest are dropped and the
+    largest count dropped so far is remembered.  A key seen for the
+    first time after that may have been dropped before, so it starts at
+    that count, which is also its largest possible overcount (this is
+    the Space-Saving algorithm applied a batch at a time).
+    """
+
+    def __init__(self, k, capacity=None):
+        self.k = k
+        self.capacity = capacity or k * 50
+        self.counts = {}
+        self.errors = {}
+        self.floor = 0
+
+    def update(self, keys, counts):
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            if key not in self.counts:
+                self.counts[key] = self.floor
+                self.errors[key] = self.floor
+            self.counts[key] += count
+        if len(self.counts) > self.capacity:
+            ranked = sorted(self.counts.items(), key=lambda i: -i[1])
+            self.floor = max(self.floor, ranked[self.capacity][1])
+            for key, _ in ranked[self.capacity:]:
+                del self.counts[key]
+                del self.errors[key]
+
+    def top(self):
+        """Return the k largest (key, count, maximum overcount) tuples"""
+        ranked = sorted(self.counts.items(), key=lambda i: -i[1])[:self.k]
+        return [(key, count, self.errors[key]) for key, count in ranked]
+
+
+class SummaryOutput(RowsOutput):
+    """Count the raw flows as they arrive instead of writing them out
+
+    Protocols and ports are counted exactly in fixed-size arrays, and
+    the busiest addresses and protocol/destination port pairs are kept
+    with TopK, so memory use doesn't grow with the number of flows.
+    The summary is printed and written to a JSON file by close(); the
+    counts saved by position() are kept until then so that an
+    interrupted download can be continued.
+    """
+
+    def __init__(self, filename, top, position=None):
+        super(SummaryOutput, self).__init__()
+        base = os.path.splitext(filename)[0]
+        self.state_path = base + ".summary.state"
+        self.summary_path = base + ".summary.json"
+        self.protocols = np.zeros(256, dtype=np.int64)
+        self.ports = {name: np.zeros(65536, dtype=np.int64)
+                      for name in ("Source_Port", "Destination_Port")}
+        self.talkers = {name: TopK(top)
+                        for name in ("Source_IPv4_Address",
+                                     "Destination_IPv4_Address")}
+        self.services = TopK(top)
+        self.top = top
+        if position is not None:
+            # Continue from the counts saved at the recorded position
+            with open(self.state_path, "rb") as f:
+                state = pickle.load(f)
+            self.__dict__.update(state)
+
+    def _add_rows(self, rows):
+        columns = {name: to_array([row[index] for row in rows],
+                                  COLUMN_TYPES[name])
+                   for name, index in self.header.items()}
+        if "IP_Protocol" in columns:
+            self.protocols += np.bincount(columns["IP_Protocol"],
+                                          minlength=256)
+        for name, counts in self.ports.items():
+            if name in columns:
+                counts += np.bincount(columns[name], minlength=65536)
+        for name, talkers in self.talkers.items():
+            if name in columns:
+                talkers.update(*np.unique(columns[name], return_counts=True))
+        if "IP_Protocol" in columns and "Destination_Port" in columns:
+            pairs = (columns["IP_Protocol"].astype(np.int64) * 65536 +
+                     columns["Destination_Port"])
+            self.services.update(*np.unique(pairs, return_counts=True))
+
+    def position(self):
+        """Save the counts so far and return the number of rows counted"""
+        self._flush_partial()
+        state = {key: value for key, value in self.__dict__.items()
+                 if key not in ("state_path", "summary_path")}
+        with open(self.state_path, "wb") as f:
+            pickle.dump(state, f)
+        return self.rows
+
+    def summary(self):
+        """Return the protocol mix and top-K lists as a dict"""
+        def ranked(counts):
+            order = np.argsort(counts)[::-1][:self.top]
+            return [(int(i), int(counts[i])) for i in order if counts[i]]
+
+        def address(value):
+            return socket.inet_ntoa(struct.pack("!I", value))
+
+        return {
+            "rows": self.rows,
+            "protocols": ranked(self.protocols),
+            "source_ports": ranked(self.ports["Source_Port"]),
+            "destination_ports": ranked(self.ports["Destination_Port"]),
+            "source_addresses": [
+                (address(key), count, error) for key, count, error
+                in self.talkers["Source_IPv4_Address"].top()],
+            "destination_addresses": [
+                (address(key), count, error) for key, count, error
+                in self.talkers["Destination_IPv4_Address"].top()],
+            "protocol_destination_ports": [
+                ("{}/{}".format(key // 65536, key % 65536), count, error)
+                for key, count, error in self.services.top()]
+        }
+
+    def close(self):
+        self.position()
+        summary = self.summary()
+        with open(self.summary_path, "w") as f:
+            json.dump(summary, f, indent=2)
+        os.remove(self.state_path)
+
+        print ('')
+        print ("Summary of {} raw flows (also in {}):".format(
+            summary["rows"], self.summary_path))
+        for title, key in (("Protocols", "protocols"),
+                           ("Source ports", "source_ports"),
+                           ("Destination ports", "destination_ports"),
+                           ("Source addresses", "source_addresses"),
+                           ("Destination addresses", "destination_addresses"),
+                           ("Protocol/destination ports",
+                            "protocol_destination_ports")):
+            print ("  {}:".format(title))
+            for entry in summary[key]:
+                print ("    {:>20} {:>12}".format(entry[0], entry[1]) +
+                       ("  (+/- {})".format(entry[2])
+                        if len(entry) > 2 and entry[2] else ""))
+
+
+def open_output(args, position=None):
+    """Open the output for the chosen format, continuing at position"""
+    if args.output_format == "columnar":
+        return ColumnarOutput(args.output_file, position)
+    if args.output_format == "summary":
+        return SummaryOutput(args.output_file, args.top, position)
+    return CsvOutput(args.output_file, position)
+
+
+def load_columnar(output_file):
+    """Memory-map the columns written by a columnar download
+
+    Returns:
+        A dict of dimension name to a read-only numpy array
+    """
+    with open(os.path.splitext(output_file)[0] + ".columns.json") as f:
+        meta = json.load(f)
+    return {column["name"]: np.memmap(column["file"], mode="r",
+                                      dtype=column["dtype"],
+                                      shape=(meta["rows"],))
+            for column in meta["columns"]}
+
+
+class Manifest(object):
+    """The progress of a download, saved next to the output file
+
+    The manifest lists each time window with the number of bytes and
+    rows downloaded for it, whether it has finished, how many of the
+    windows have been appended to the output, and the size of the
+    output after the last one (in bytes for CSV, rows for columnar and
+    summary).  The shard files hold the downloaded windows themselves,
+    so a re-run only has to fetch the windows that haven't finished.
+    """
+
+    def __init__(self, args, windows, limit):
+        self.path = "{}.manifest".format(args.output_file)
+        self.lock = threading.Lock()
+        self.query = {"windows": [[w[0].isoformat(), w[1].isoformat()]
+                                  for w in windows],
+                      "limit": limit,
+                      "output_format": args.output_format,
+                      "perspective": args.perspective,
+                      "view": args.view,
+                      "time_dimension": args.time_dimension}
+        self.shards = [{"file": "{}.shard{}".format(args.output_file, i),
+                        "bytes": 0,
+                        "rows": 0,
+                        "complete": False}
+                       for i in range(len(windows))]
+        self.appended = 0
+        self.output_position = 0
+
+        if args.resume and os.path.exists(self.path):
+            with open(self.path) as f:
+                saved = json.load(f)
+            if saved["query"] == self.query:
+                self.shards = saved["shards"]
+                self.appended = saved["appended"]
+                self.output_position = saved["output_position"]
+            else:
+                print ("  The manifest {} is for a different query; "
+                       "starting over".format(self.path))
+
+    def save(self):
+        """Write the manifest, replacing the previous one atomically"""
+        with self.lock:
+            with open(self.path + ".tmp", "w") as f:
+                json.dump({"query": self.query,
+                           "shards": self.shards,
+                           "appended": self.appended,
+                           "output_position": self.output_position}, f)
+            os.rename(self.path + ".tmp", self.path)
+
+    def remove(self):
+        os.remove(self.path)
+
+
+def count_rows(filename):
+    """Count the lines in a file without reading it all into memory"""
+    rows = 0
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            rows += chunk.count(b"\n")
+    return rows
+
+
+def download_shard(args, leaderurl, manifest, shard, window):
+    """Download the raw flows for one window into its own file
+
+    A shard file left over from an interrupted download is started
+    again, since the leader can't be asked for only the rest of it.
+
+    Returns:
+        The query start, query end and write end times
+    """
+    entry = manifest.shards[shard]
+    query_start = datetime.now()
+    answer = post_query(args, leaderurl,
+                        build_query(args, window[0], window[1],
+                                    manifest.query["limit"]))
+    query_end = datetime.now()
+    if answer.status_code != requests.codes.ok:
+        raise RuntimeError(
+            "shard #{} failed, run again with --resume: {}".format(
+                shard, answer.text))
+    size, rows = 0, 0
+    with open(entry["file"], "wb") as f:
+        for chunk in answer.iter_content(chunk_size=CHUNK_SIZE):
+            f.write(chunk)
+            rows += chunk.count(b"\n")
+            size += len(chunk)
+    entry.update(bytes=size, rows=rows, complete=True)
+    manifest.save()
+    return query_start, query_end, datetime.now()
+
+
+def download_sharded(args, leaderurl, start, end):
+    """Download the raw flows for several windows at the same time
+
+    Each window's CSV is downloaded to its own shard file and appended
+    to the output as soon as it and all of the windows before it have
+    finished, so the output is in time order and only the first
+    window's CSV header is kept.  For the columnar and summary formats
+    the shard files are still CSV, so there must be room for them.  Progress
+    is recorded in a manifest so that an interrupted download can be
+    continued with --resume.
+
+    Returns:
+        The time by which the leader had answered every window's query
+    """
+    windows = shard_windows(start, end, args.shards)
+    limit = -(-args.num_records // args.shards)
+    manifest = Manifest(args, windows, limit)
+    manifest.save()
+    answered = [datetime.now()]
+    with ThreadPoolExecutor(max_workers=args.shards) as pool:
+        futures = {shard: pool.submit(download_shard, args, leaderurl,
+                                      manifest, shard, window)
+                   for shard, window in enumerate(windows)
+                   if shard >= manifest.appended and
+                   not manifest.shards[shard]["complete"]}
+        output = open_output(args, manifest.output_position
+                             if manifest.appended else None)
+        try:
+            for shard in range(manifest.appended, len(windows)):
+                entry = manifest.shards[shard]
+                if shard in futures:
+                    query_start, query_end, write_end = \
+                        futures[shard].result()
+                    answered.append(query_end)
+                else:
+                    print ("  Shard #{} was already downloaded".format(
+                        shard))
+
+                # Make sure the file holds what was downloaded before
+                # it becomes part of the output
+                if count_rows(entry["file"]) != entry["rows"]:
+                    print ("ERROR: shard #{} should have {} rows but {} "
+                           "has {}; run again with --resume".format(
+                               shard, entry["rows"], entry["file"],
+                               count_rows(entry["file"])))
+                    entry.update(bytes=0, rows=0, complete=False)
+                    manifest.save()
+                    sys.exit(1)
+                # The first row of every shard is the CSV header
+                if entry["rows"] - 1 >= limit:
+                    print ("  Shard #{} returned its limit of {} records; "
+                           "use more shards or a larger -n to get all of "
+                           "its raw flows".format(shard, limit))
+
+                with open(entry["file"], "rb") as shard_f:
+                    if shard > 0:
+                        shard_f.readline()
+                    for chunk in iter(lambda: shard_f.read(CHUNK_SIZE),
+                                      b""):
+                        output.write(chunk)
+                manifest.appended = shard + 1
+                manifest.output_position = output.position()
+                manifest.save()
+                os.remove(entry["file"])
+                print ("  Shard #{} ({} to {}) written to {}".format(
+                    shard, windows[shard][0].isoformat(),
+                    windows[shard][1].isoformat(), args.output_file))
+                if shard in futures:
+                    print_times(query_start, query_end, write_end, '    ')
+        except BaseException:
+            # Leave the output as it was at the last appended shard so
+            # that --resume can continue it
+            output.abandon()
+            raise
+        output.close()
+    manifest.remove()
+    return max(answered)
+
+
 if __name__ == '__main__':
 
     args = parse_cmdline_args()
@@ -70,57 +678,37 @@ if __name__ == '__main__':
 
     # Use Python's parse/fuzzy date interpreter to try to get useful dates
     try:
-        start = parse(args.start, fuzzy=True).isoformat()
-        end = parse(args.end, fuzzy=True).isoformat()
+        start = parse(args.start, fuzzy=True)
+        end = parse(args.end, fuzzy=True)
     except ValueError:
         print ("ERROR: I couldn't parse the dates you provided ("
                "start: {}, end: {}), please try another format.".format(
                    args.start, args.end))
         sys.exit(1)
 
-    query = {
-        "start": start,
-        "end": end,
-        "dimensions": [
-            "IP_Protocol",
-            "Source_IPv4_Address",
-            "Source_Port",
-            "Destination_IPv4_Address",
-            "Destination_Port"
-        ],
-        "limit": args.num_records,
-        "perspective": args.perspective,
-        "view": args.view
-    }
-
     print ("  Querying {} for {} raw flows records between {} and {}...".
            format(
                args.leader,
                args.num_records,
-               start,
-               end))
+               start.isoformat(),
+               end.isoformat()))
 
     query_start = datetime.now()
-    answer = requests.post(leaderurl,
-                           headers={"X-Arbux-APIToken": args.apikey,
-                                    "Content-Type": "application/vnd.api+json",
-                                    "Accept": "text/csv"},
-                           data=json.dumps(query), verify=args.certfile,
-                           stream=True)
-    query_end = datetime.now()
-    with open(args.output_file, "wb") as f:
-        for i, chunk in enumerate(answer.iter_content(chunk_size=262144)):
+    if args.shards > 1 or args.resume:
+        query_end = download_sharded(args, leaderurl, start, end)
+    else:
+        answer = post_query(args, leaderurl,
+                            build_query(args, start, end, args.num_records))
+        query_end = datetime.now()
+        output = open_output(args)
+        for i, chunk in enumerate(answer.iter_content(chunk_size=CHUNK_SIZE)):
             print ("  Writing chunk #{} to {}".format(i, args.output_file),
                    end='\r')
-            f.write(chunk)
+            output.write(chunk)
+        output.close()
 
     write_end = datetime.now()
 
     # Print some timing information
     print ('')
-    print ("Query time: {0:10.1f} seconds".format(
-        ((query_end-query_start).total_seconds())))
-    print ("Write time: {0:10.1f} seconds".format(
-        ((write_end-query_end).total_seconds())))
-    print ("Total time: {0:10.1f} seconds".format(
-        ((write_end-query_start).total_seconds())))
+    print_times(query_start, query_end, write_end)
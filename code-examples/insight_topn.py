@@ -0,0 +1,333 @@
+"""Run an Insight `topn` query as several smaller queries at the same time
+
+A `topn` query whose filters OR together several selectors (for example
+destination ports 80, 25, 53, and 443) can be split into one query per
+selector, and any `topn` query can be split into several shorter time
+slices or into calendar days (UTC).  The smaller queries are POSTed at the
+same time and their results are merged back into one list with the query's
+`limit` applied at the end.
+
+Splitting by selector also gives the top N for each selector, which the
+single query can't return.  Splitting by time is an approximation: each
+slice only returns its own top rows, so a group that is just outside the
+top of a slice has no value for it.  Each slice asks for
+`SLICE_LIMIT_FACTOR` times the query's `limit` to make that unlikely, and
+rows that are missing from a slice that was cut off by its limit are marked
+with the number of such slices in `partial_slices`.
+
+Results are cached on disk, keyed by a hash of the leader, API token, and
+query with its keys sorted and its `start` and `end` times normalized.  The
+results for a time range that ended more than `SETTLE_SECONDS` ago won't
+change, so they are kept forever; results for a time range that includes
+the present are kept for `OPEN_WINDOW_TTL` seconds.  Together with
+splitting by day, that means a report over several days only has to query
+Insight for the current day each time it runs.
+
+    import insight_topn
+    rows, per_query = insight_topn.fan_out_topn(leader, apikey, query)
+
+The non-standard Python packages required are:
+  - requests; http://docs.python-requests.org/
+  - python-dateutil; https://dateutil.readthedocs.io/
+"""
+
+from __future__ import print_function
+import hashlib
+import heapq
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import requests
+from dateutil.parser import parse
+from dateutil.tz import tzlocal, tzutc
+
+CERT_FILE = './certfile'
+# The most queries that are sent to Insight at the same time
+MAX_WORKERS = 8
+# Where query results are cached; set to None to turn off caching
+CACHE_DIR = './insight-cache'
+# How long to keep results for a time range that hasn't finished yet
+OPEN_WINDOW_TTL = 60
+# How long after a time range ends before Insight's data for it is complete
+SETTLE_SECONDS = 900
+# How many times the query's limit each time slice asks for
+SLICE_LIMIT_FACTOR = 4
+
+
+def to_utc(when):
+    """Parse a time, assuming local time if it has no timezone, and
+    convert it to UTC"""
+    when = parse(when) if not isinstance(when, datetime) else when
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=tzlocal())
+    return when.astimezone(tzutc())
+
+
+def query_hash(leader, apikey, query):
+    """Hash a query so equivalent queries get the same cache entry"""
+    normalized = dict(query)
+    for name in ('start', 'end'):
+        if normalized.get(name):
+            normalized[name] = to_utc(normalized[name]).isoformat()
+    body = json.dumps([leader, hashlib.sha256(apikey.encode()).hexdigest(),
+                       normalized], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+def cache_lifetime(query):
+    """Return how many seconds to keep a query's results, or None for ever"""
+    settled = time.time() - SETTLE_SECONDS
+    if query.get('end') and to_utc(query['end']).timestamp() < settled:
+        return None
+    return OPEN_WINDOW_TTL
+
+
+def read_cache(key):
+    """Return the cached result rows for a key, or None"""
+    if CACHE_DIR is None:
+        return None
+    try:
+        with open(os.path.join(CACHE_DIR, key + '.json')) as f:
+            entry = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if entry['expires'] is not None and entry['expires'] < time.time():
+        return None
+    return entry['data']
+
+
+def write_cache(key, query, rows):
+    """Cache the result rows of a query"""
+    if CACHE_DIR is None:
+        return
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    lifetime = cache_lifetime(query)
+    entry = {'expires': None if lifetime is None else time.time() + lifetime,
+             'query': query,
+             'data': rows}
+    path = os.path.join(CACHE_DIR, key + '.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(entry, f)
+    os.rename(path + '.tmp', path)
+
+
+def post_topn(leader, apikey, query):
+    """POST one topn query and return the list of result rows
+
+    The rows are returned from the cache instead if they are there.
+    """
+    key = query_hash(leader, apikey, query)
+    rows = read_cache(key)
+    if rows is not None:
+        return rows
+
+    url = 'https://{}/api/sp/insight/topn'.format(leader)
+    results = requests.post(
+        url,
+        headers={'X-Arbux-APIToken':
+                 apikey,
+                 'Content-Type':
+                 'application/vnd.api+json'},
+        json=query,
+        verify=CERT_FILE)
+
+    if results.status_code != requests.codes.ok:
+        print("Insight topn query failed: [{}] {}".format(
+            results.status_code, results.text), file=sys.stderr)
+        sys.exit(1)
+
+    rows = results.json()['data']
+    write_cache(key, query, rows)
+    return rows
+
+
+def split_by_selector(query):
+    """Make one query for each selector in an "or" filter
+
+    Queries without an "or" filter of more than one selector are returned
+    unchanged in a list of one.
+    """
+    filters = query.get('filters') or {}
+    fields = filters.get('fields', [])
+    if filters.get('type') != 'or' or len(fields) < 2:
+        return [query]
+    return [dict(query, filters={'type': 'or', 'fields': [field]})
+            for field in fields]
+
+
+def split_by_time(query, slices):
+    """Make one query for each of `slices` equal parts of the time range"""
+    start = parse(query['start'])
+    end = parse(query['end'])
+    width = (end - start) / slices
+    edges = [start + width * i for i in range(slices)] + [end]
+    return [dict(query, start=edges[i].isoformat(),
+                 end=edges[i + 1].isoformat())
+            for i in range(slices)]
+
+
+def split_by_day(query):
+    """Make one query for each UTC day in the time range
+
+    The first and last queries are cut to the query's start and end, so
+    the other days are always whole days and their queries are the same
+    every time a report asks about them.
+    """
+    start = to_utc(query['start'])
+    end = to_utc(query['end'])
+    edges = [start]
+    midnight = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    while midnight + timedelta(days=1) < end:
+        midnight += timedelta(days=1)
+        edges.append(midnight)
+    edges.append(end)
+    return [dict(query, start=edges[i].isoformat(),
+                 end=edges[i + 1].isoformat())
+            for i in range(len(edges) - 1)]
+
+
+def run_queries(leader, apikey, queries, workers=MAX_WORKERS):
+    """POST several topn queries at the same time
+
+    Returns a list with the result rows of each query, in the same order as
+    the queries
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda q: post_topn(leader, apikey, q),
+                             queries))
+
+
+def metric_key(query, value='total'):
+    """Return a function that gets the value to rank a result row by"""
+    metric = query['metric']
+    calculation = query['calculation']
+    return lambda row: row[metric][calculation][value]
+
+
+def merge_ranked(results, key, groupby, limit):
+    """Merge result lists from queries for different selectors
+
+    Each list is sorted and then they are merged with a k-way heap merge,
+    stopping once `limit` rows have been taken.  A row that matched more
+    than one selector is only taken once.
+    """
+    ranked = [sorted(rows, key=key, reverse=True) for rows in results]
+    seen = set()
+    merged = []
+    for row in heapq.merge(*ranked, key=key, reverse=True):
+        group = tuple(row[facet] for facet in groupby)
+        if group in seen:
+            continue
+        seen.add(group)
+        merged.append(row)
+        if len(merged) == limit:
+            break
+    return merged
+
+
+def combine_time_slices(queries, results, key, limit):
+    """Combine result lists for consecutive time slices of one query
+
+    Rows for the same group are combined: averages are weighted by the
+    length of each slice and maxima take the largest value.  A group missing
+    from a slice that returned fewer rows than its limit had no traffic in
+    it.  A group missing from a slice that returned its full limit may just
+    have been below that slice's top rows, so its combined values are only a
+    lower bound; each row gets `partial_slices`, the number of such slices
+    for its group (0 when its values are exact).  The top `limit` rows of
+    the combined results are returned.
+    """
+    calculation = queries[0]['calculation']
+    if calculation not in ('average', 'max'):
+        raise ValueError("can't combine {} results from different time "
+                         "ranges".format(calculation))
+    metric = queries[0]['metric']
+    groupby = queries[0]['groupby']
+    durations = [(parse(q['end']) - parse(q['start'])).total_seconds()
+                 for q in queries]
+    total_duration = sum(durations)
+
+    full = [len(rows) >= q['limit'] for q, rows in zip(queries, results)]
+
+    combined = {}
+    seen = {}
+    for index, (duration, rows) in enumerate(zip(durations, results)):
+        for row in rows:
+            group = tuple(row[facet] for facet in groupby)
+            values = row[metric][calculation]
+            if group not in combined:
+                combined[group] = dict(row)
+                combined[group][metric] = {
+                    calculation: dict.fromkeys(values, 0)}
+            seen.setdefault(group, set()).add(index)
+            totals = combined[group][metric][calculation]
+            for name, value in values.items():
+                if calculation == 'average':
+                    totals[name] += value * duration / total_duration
+                else:
+                    totals[name] = max(totals[name], value)
+
+    for group, row in combined.items():
+        row['partial_slices'] = sum(1 for index, is_full in enumerate(full)
+                                    if is_full and index not in seen[group])
+    return heapq.nlargest(limit, combined.values(), key=key)
+
+
+def fan_out_topn(leader, apikey, query, split='selectors', slices=2,
+                 value='total', workers=MAX_WORKERS,
+                 slice_limit_factor=SLICE_LIMIT_FACTOR):
+    """Run a topn query as several queries at the same time
+
+    Args:
+        leader: the Sightline leader to send the queries to
+        apikey: an API token for the leader
+        query: the topn query
+        split: 'selectors' for one query for each selector in the query's
+            "or" filter, 'time' for `slices` equal time ranges, or 'day'
+            for one query for each UTC day
+        slices: the number of time ranges when `split` is 'time'
+        value: which value of the metric ('in', 'out', or 'total') to rank
+            the rows by
+        workers: the most queries to send at the same time
+        slice_limit_factor: how many times the query's limit each time
+            slice asks for when `split` is 'time' or 'day'
+
+    Returns:
+        The merged result rows, limited to the query's limit, and a list of
+        (query, result rows) tuples for each of the smaller queries; when
+        split by time, each row has `partial_slices` (see
+        combine_time_slices())
+    """
+    if split in ('time', 'day'):
+        sliced = dict(query, limit=query['limit'] * slice_limit_factor)
+        if split == 'time':
+            queries = split_by_time(sliced, slices)
+        else:
+            queries = split_by_day(sliced)
+    else:
+        queries = split_by_selector(query)
+    results = run_queries(leader, apikey, queries, workers)
+
+    key = metric_key(query, value)
+    if split in ('time', 'day'):
+        rows = combine_time_slices(queries, results, key, query['limit'])
+    else:
+        rows = merge_ranked(results, key, query['groupby'], query['limit'])
+    return rows, list(zip(queries, results))
+
+
+if __name__ == '__main__':
+    # Run a topn query from a JSON file, split by selector, and print the
+    # merged results
+    if len(sys.argv) != 4:
+        print("usage: {} <leader> <api token> <query.json>".format(
+            sys.argv[0]), file=sys.stderr)
+        sys.exit(1)
+    with open(sys.argv[3]) as f:
+        query = json.load(f)
+    rows, per_query = fan_out_topn(sys.argv[1], sys.argv[2], query)
+    print(json.dumps({'data': rows}, indent=2))
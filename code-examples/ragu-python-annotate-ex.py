@@ -1,5 +1,7 @@
 from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import os
 import sys
 import requests      # version: 2.28.1
 import json
@@ -7,6 +9,15 @@ import urllib.parse  # version: 1.16.13
 import slenv
 
 CERT_FILE = './certfile'
+# The author of the annotations this script writes
+ANNOTATION_AUTHOR = 'API-Client'
+# The most alerts that are annotated at the same time
+MAX_WORKERS = 8
+# Where the impact each alert was last annotated with is kept
+STATE_FILE = './annotation-state.json'
+# How much (as a fraction) the impact bps or pps has to change before an
+# alert is annotated again
+CHANGE_THRESHOLD = 0.25
 
 
 def api_request(URL, key, body=None):
@@ -52,6 +63,36 @@ def api_request(URL, key, body=None):
     return api_response['data']
 
 
+def api_get_pages(URL, key):
+    """ GET every page of a list, following the "next" links
+
+    Args:
+        URL: valid URL of the first page
+        key: API key generated on the given SP leader
+
+    Returns:
+        List of the 'data' items from every page, or None if any
+        request failed
+    """
+
+    items = []
+    while URL:
+        api_response = requests.get(
+            URL,
+            headers={'X-Arbux-APIToken': key,
+                     'Content-Type': 'application/vnd.api+json'},
+            verify=CERT_FILE)
+        if (api_response.status_code != requests.codes.ok):
+            print("API responded with this error: \n{}".format(
+                api_response.text),
+                file=sys.stderr)
+            return None
+        api_response = api_response.json()
+        items.extend(api_response['data'])
+        URL = api_response.get('links', {}).get('next')
+    return items
+
+
 def get_alerts(leader, key):
     """ Retrieve alerts from an SP leader
 
@@ -60,13 +101,14 @@ def get_alerts(leader, key):
         key: API key generated on the given SP leader
 
     Returns:
-        List of impact data containing alerts
+        List of impact data containing alerts, from every page, or
+        None if they couldn't be fetched
     """
 
     print("Fetching ongoing alerts from {}".format(leader))
 
     # Craft the URL components, filtering based on ongoing dos alerts
-    ALERT_URI = '/api/sp/alerts/?filter='
+    ALERT_URI = '/api/sp/alerts/?perPage=50&filter='
     FILTER = ("/data/attributes/ongoing = true AND " +
               "/data/attributes/alert_class = dos")
 
@@ -74,9 +116,9 @@ def get_alerts(leader, key):
     FILTER = urllib.parse.quote(FILTER, safe='')
     URL = "https://" + leader + ALERT_URI + FILTER
 
-    # Make the api request and return its results
-    api_response = api_request(URL, key)
-    return api_response
+    # Make the api requests, following the "next" links to get every
+    # page, and return their results
+    return api_get_pages(URL, key)
 
 
 def create_annotation_msg(impact_data):
@@ -137,54 +179,221 @@ def extract_impact_info(alert):
     return impact
 
 
-def annotate(leader, key, alerts):
-    """ Annotate a series of alerts from a given SP leader
+def load_state(filename=STATE_FILE):
+    """ Load the impact each alert was last annotated with
+
+    Args:
+        filename: path of the state file
+
+    Returns:
+        dict of alert ID to [bps, pps, boundary] lists
+    """
+
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as state_file:
+        return json.load(state_file)
 
-    Each alert is annotated with its own impact data
+
+def save_state(state, filename=STATE_FILE):
+    """ Save the impact each alert was last annotated with
 
     Args:
-        leader: SP leader from which the alerts originated
+        state: dict of alert ID to [bps, pps, boundary] lists
+        filename: path of the state file
+    """
+
+    with open(filename + '.tmp', 'w') as state_file:
+        json.dump(state, state_file, separators=(',', ':'))
+    os.rename(filename + '.tmp', filename)
+
+
+def impact_state(impact):
+    """ Turn impact data into the compact form kept in the state
+
+    Args:
+        impact: dict from extract_impact_info()
+
+    Returns:
+        [bps, pps, boundary] list; boundary is None if the alert
+        has none
+    """
+
+    return [impact['bps'], impact['pps'], impact.get('boundary')]
+
+
+def significant_change(last, impact, threshold=CHANGE_THRESHOLD):
+    """ Decide if an alert's impact has changed enough to annotate
+    it again
+
+    Args:
+        last: [bps, pps, boundary] the alert was last annotated
+            with, or None if it hasn't been
+        impact: dict from extract_impact_info()
+        threshold: the fraction the bps or pps has to change by
+
+    Returns:
+        True if the boundary changed or the bps or pps changed by
+        more than the threshold
+    """
+
+    if last is None:
+        return True
+    current = impact_state(impact)
+    if current[2] != last[2]:
+        return True
+    return any(abs(new - old) > threshold * max(abs(old), 1)
+               for new, old in zip(current[:2], last[:2]))
+
+
+def get_last_annotation(leader, key, alert_id):
+    """ Get the text of the newest annotation this script wrote
+    on an alert
+
+    Every page of the alert's annotations is read, since a
+    long-lived alert can have more than fit on one page.
+
+    Args:
+        leader: SP leader from which the alert originated
         key: API key generated on the given SP leader
-        alerts: list of impact data containing alerts to be annotated
+        alert_id: ID of the alert
+
+    Returns:
+        The annotation text, '' if there isn't one, or None if the
+        annotations couldn't be fetched
     """
 
-    print("Annotating {} ongoing alerts with impact data".format(
-        len(alerts)))
+    ALERT_URI = ("/api/sp/alerts/{}/annotations/?perPage=50").format(
+        alert_id)
+    URL = "https://" + leader + ALERT_URI
 
-    for alert in alerts:
-
-        # Create the POST body for each annotation
-        impact = extract_impact_info(alert)
-        msg = create_annotation_msg(impact)
-        post = {
-            "data": {
-                "attributes": {
-                    "author": "API-Client",
-                    "text": msg
-                }
+    annotations = api_get_pages(URL, key)
+    if annotations is None:
+        return None
+    annotations = [annotation['attributes'] for annotation in annotations
+                   if annotation['attributes'].get('author') ==
+                   ANNOTATION_AUTHOR]
+    if not annotations:
+        return ''
+    return max(annotations, key=lambda a: a['added'])['text']
+
+
+def annotate_alert(leader, key, alert):
+    """ Annotate one alert with its impact data, unless its newest
+    annotation already says the same thing
+
+    Args:
+        leader: SP leader from which the alert originated
+        key: API key generated on the given SP leader
+        alert: impact data containing alert to be annotated
+
+    Returns:
+        'annotated', 'unchanged', or 'failed'
+    """
+
+    # Create the POST body for the annotation
+    impact = extract_impact_info(alert)
+    msg = create_annotation_msg(impact)
+    last = get_last_annotation(leader, key, alert['id'])
+    if last is None:
+        # without the annotations it might be a duplicate, so try again
+        # on the next run
+        return 'failed'
+    if last == msg:
+        return 'unchanged'
+
+    post = {
+        "data": {
+            "attributes": {
+                "author": ANNOTATION_AUTHOR,
+                "text": msg
             }
         }
+    }
 
-        # Create a unique URL for each annotation
-        # Each one must reference the alert from which impact data
-        # is being retreived
-        ALERT_URI = ("/api/sp/alerts/{}/annotations/").format(
-            alert['id'])
-        URL = "https://" + leader + ALERT_URI
+    # Create a unique URL for the annotation
+    # It must reference the alert from which impact data
+    # is being retreived
+    ALERT_URI = ("/api/sp/alerts/{}/annotations/").format(
+        alert['id'])
+    URL = "https://" + leader + ALERT_URI
 
-        # POST annotation
-        api_response = api_request(
-            URL, key, json.dumps(post))
+    # POST annotation
+    api_response = api_request(
+        URL, key, json.dumps(post))
 
-        # Handle any API response
-        if api_response:
+    return 'annotated' if api_response else 'failed'
+
+
+def annotate(leader, key, alerts, state=None, threshold=CHANGE_THRESHOLD,
+             workers=MAX_WORKERS):
+    """ Annotate a series of alerts from a given SP leader
+
+    Each alert is annotated with its own impact data.  The alerts
+    are handled at the same time, up to `workers` at once, so the
+    run takes about as long as the slowest alert rather than all of
+    them added together.
+
+    When `state` is given, an alert whose impact hasn't changed
+    significantly since it was last annotated is skipped without any
+    request, and the state is updated with the impact of the alerts
+    that are annotated; alerts that aren't in `alerts` any more are
+    dropped from it.
+
+    Args:
+        leader: SP leader from which the alerts originated
+        key: API key generated on the given SP leader
+        alerts: list of impact data containing alerts to be annotated
+        state (optional): dict from load_state()
+        threshold: the fraction the bps or pps has to change by
+        workers: the most alerts to annotate at the same time
+
+    Returns:
+        dict of alert ID to 'annotated', 'unchanged', 'insignificant',
+        or 'failed'
+    """
+
+    print("Annotating {} ongoing alerts with impact data".format(
+        len(alerts)))
+
+    results = {}
+    impacts = {alert['id']: extract_impact_info(alert) for alert in alerts}
+    if state is not None:
+        for alert_id in list(state):
+            if alert_id not in impacts:
+                del state[alert_id]
+        for alert_id, impact in impacts.items():
+            if not significant_change(state.get(alert_id), impact,
+                                      threshold):
+                results[alert_id] = 'insignificant'
+    changed = [alert for alert in alerts if alert['id'] not in results]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results.update(zip(
+            [alert['id'] for alert in changed],
+            pool.map(lambda alert: annotate_alert(leader, key, alert),
+                     changed)))
+
+    if state is not None:
+        for alert_id, result in results.items():
+            if result in ('annotated', 'unchanged'):
+                state[alert_id] = impact_state(impacts[alert_id])
+
+    # Handle any API responses
+    for alert_id, result in results.items():
+        if result == 'annotated':
             print("Alert {} annotated".format(
-                alert['id']))
-        else:
+                alert_id))
+        elif result == 'unchanged':
+            print("Alert {} already has this impact data".format(
+                alert_id))
+        elif result == 'failed':
             print("Could not annotate Alert {}".format(
-                alert['id']),
+                alert_id),
                 file=sys.stderr)
 
+    return results
+
 
 #####################
 # Start the Program #
@@ -196,10 +405,22 @@ def main():
     API_KEY = slenv.apitoken
 
     print('Starting auto-annotation script')
+    state = load_state()
     alerts = get_alerts(SP_LEADER, API_KEY)
+    if alerts is None:
+        # keep the state as it is; the alerts are still there
+        print('Could not get the alerts', file=sys.stderr)
+        sys.exit(1)
     if alerts:
         print('Alerts retrieved. Auto-annotating impact data')
-        annotate(SP_LEADER, API_KEY, alerts)
+        results = annotate(SP_LEADER, API_KEY, alerts, state)
+        skipped = list(results.values()).count('insignificant')
+        if skipped:
+            print('{} alerts skipped; their impact changed by less than '
+                  '{:.0%}'.format(skipped, CHANGE_THRESHOLD))
+    else:
+        state.clear()
+    save_state(state)
 
     print('Done')
 
@@ -1,10 +1,35 @@
 from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+import argparse
+import os
 import sys
 import requests  # version: 2.28.1
 import json
 import slenv
 
 CERT_FILE = "./certfile"
+# The policy is read from this file if it exists; DEFAULT_POLICY is used
+# if it doesn't
+POLICY_FILE = "./appliance-limits.json"
+# Every rule whose selector matches a device applies its attributes to
+# it, later rules overriding earlier ones.  A selector can have any of
+# "device_type", "name" (a shell-style pattern like "tms-*"), and "id",
+# each either a value or a list of values; an empty selector matches
+# every device.  A rule with "unset_only" set only gives a device the
+# attributes that it and the earlier rules leave unset, so the default
+# never overwrites a limit that was configured some other way.
+DEFAULT_POLICY = [
+    {
+        "select": {},
+        "unset_only": True,
+        "attributes": {
+            "metrics_items_tracked_per_day_limit": 15
+        }
+    }
+]
+# The most devices that are changed at the same time
+MAX_WORKERS = 8
 
 
 def api_request(URL, key, body=None):
@@ -64,55 +89,199 @@ def get_appliances(leader, key):
     print("Retrieving appliances from {}".format(leader))
 
     # Craft the URL components
-    APPLIANCE_URI = '/api/sp/devices/'
+    APPLIANCE_URI = '/api/sp/devices/?perPage=100'
     URL = "https://" + leader + APPLIANCE_URI
 
-    # Make the api request and return its results
-    api_response = api_request(URL, key)
-    return api_response
+    # Make the api requests, following the "next" links to get every
+    # page, and return their results
+    appliances = []
+    while URL:
+        api_response = requests.get(
+            URL,
+            headers={'X-Arbux-APIToken': key,
+                     'Content-Type': 'application/vnd.api+json'},
+            verify=CERT_FILE)
+        if (api_response.status_code != requests.codes.ok):
+            print("API responded with this error: \n{}".format(
+                api_response.text),
+                file=sys.stderr)
+            return []
+        api_response = api_response.json()
+        appliances.extend(api_response['data'])
+        URL = api_response.get('links', {}).get('next')
+    return appliances
 
 
-def set_limits(leader, key, appliances):
-    """ Configure the provided appliances with limits
+def load_policy(filename):
+    """ Load the limits policy
+
+    Args:
+        filename: JSON file with a list of rules, each with a
+            "select" and an "attributes" dict
+
+    Returns:
+        List of policy rules; DEFAULT_POLICY if the file doesn't
+        exist
+    """
+
+    if not os.path.exists(filename):
+        return DEFAULT_POLICY
+    with open(filename) as policy_file:
+        return json.load(policy_file)
+
+
+def selects(selector, appliance):
+    """ Check if a policy selector matches an appliance
+
+    Args:
+        selector: dict of "device_type", "name", and "id" values or
+            lists of values
+        appliance: an appliance from get_appliances()
+
+    Returns:
+        True if the appliance matches every part of the selector
+    """
+
+    attributes = appliance['attributes']
+    for field, wanted in selector.items():
+        if not isinstance(wanted, list):
+            wanted = [wanted]
+        if field == 'id':
+            actual = appliance['id']
+        else:
+            actual = attributes.get(field)
+        if field == 'name':
+            if actual is None or not any(fnmatch(actual, pattern)
+                                         for pattern in wanted):
+                return False
+        elif actual not in [str(value) if field == 'id' else value
+                            for value in wanted]:
+            return False
+    return True
+
+
+def plan_limits(appliances, policy):
+    """ Work out which attributes of which appliances have to change
+
+    Rules with "unset_only" only fill in attributes that the
+    appliance and the earlier rules leave unset.
 
     Args:
-        leader: SP leader from which the appliances exist
-        key: API key generated on the given SP leader
         appliances: List of appliances
+        policy: List of policy rules
+
+    Returns:
+        List of (appliance, changes) tuples, where changes holds only
+        the attributes whose current values differ from the policy;
+        appliances that already comply are left out
     """
 
+    plan = []
     for appliance in appliances:
-        LIMIT = 'metrics_items_tracked_per_day_limit'
-        LIMIT_VALUE = 15
-        if LIMIT not in appliance['attributes']:
-            patch = {
-                "data": {
-                    "attributes": {
-                        LIMIT: LIMIT_VALUE
-                    }
-                }
+        desired = {}
+        for rule in policy:
+            if not selects(rule.get('select', {}), appliance):
+                continue
+            for name, value in rule['attributes'].items():
+                if rule.get('unset_only') and (
+                        name in desired or
+                        appliance['attributes'].get(name) is not None):
+                    continue
+                desired[name] = value
+        changes = {name: value for name, value in desired.items()
+                   if appliance['attributes'].get(name) != value}
+        if changes:
+            plan.append((appliance, changes))
+    return plan
+
+
+def print_plan(plan):
+    """ Print the changes that will be made to each appliance
+
+    Args:
+        plan: List of (appliance, changes) tuples from plan_limits()
+    """
+
+    for appliance, changes in plan:
+        print("Device {id} ({name}):".format(
+            id=appliance['id'],
+            name=appliance['attributes'].get('name', '')))
+        for name, value in sorted(changes.items()):
+            print("    {}: {} -> {}".format(
+                name, appliance['attributes'].get(name), value))
+
+
+def set_limits(leader, key, plan, workers=MAX_WORKERS):
+    """ Configure the appliances in a plan with their limits
+
+    The appliances are PATCHed at the same time, up to `workers` at
+    once, and only with the attributes that change.
+
+    Args:
+        leader: SP leader from which the appliances exist
+        key: API key generated on the given SP leader
+        plan: List of (appliance, changes) tuples from plan_limits()
+        workers: the most appliances to change at the same time
+
+    Returns:
+        The number of appliances that could not be configured
+    """
+
+    def patch_appliance(appliance, changes):
+        patch = {
+            "data": {
+                "attributes": changes
             }
+        }
 
-            # Create a unique URL for the appliance
-            DEVICE_URI = ("/api/sp/devices/{}".format(
-                appliance['id']))
-            URL = "https://" + leader + DEVICE_URI
+        # Create a unique URL for the appliance
+        DEVICE_URI = ("/api/sp/devices/{}".format(
+            appliance['id']))
+        URL = "https://" + leader + DEVICE_URI
 
-            # PATCH the appliance
-            api_response = api_request(URL, key, json.dumps(patch))
+        # PATCH the appliance
+        return api_request(URL, key, json.dumps(patch))
 
-            # Handle any API response
-            if api_response:
-                print("Device {id}: {limit} configured".format(
-                    id=appliance['id'], limit=LIMIT))
-            else:
-                print("Could not configure device {}".format(
-                    appliance['id']),
-                    file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        responses = list(pool.map(lambda step: patch_appliance(*step),
+                                  plan))
 
+    # Handle any API responses
+    failed = 0
+    for (appliance, changes), api_response in zip(plan, responses):
+        if api_response:
+            print("Device {id}: {limits} configured".format(
+                id=appliance['id'], limits=", ".join(sorted(changes))))
         else:
-            print("Device {id}: {limit} is already configured".format(
-                id=appliance['id'], limit=LIMIT))
+            failed += 1
+            print("Could not configure device {}".format(
+                appliance['id']),
+                file=sys.stderr)
+    return failed
+
+
+def parse_cmdline_args():
+    """Parse the command line options and set some useful defaults"""
+    parser = argparse.ArgumentParser(
+        description='Apply a policy of limits to the appliances',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '-p', '--policy',
+        default=POLICY_FILE,
+        dest='policy',
+        help='JSON file with the limits policy')
+    parser.add_argument(
+        '-n', '--dry_run',
+        action='store_true',
+        dest='dry_run',
+        help='Only print the changes that would be made')
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=MAX_WORKERS,
+        dest='workers',
+        help='Number of appliances to change at the same time')
+    return parser.parse_args()
 
 
 #####################
@@ -124,11 +293,19 @@ def main():
     SP_LEADER = slenv.leader
     API_KEY = slenv.apitoken
 
+    args = parse_cmdline_args()
+
     print('Starting appliance-limiting script')
+    policy = load_policy(args.policy)
     appliances = get_appliances(SP_LEADER, API_KEY)
     if appliances:
-        print('Appliances retrieved. Configuring limits')
-        set_limits(SP_LEADER, API_KEY, appliances)
+        plan = plan_limits(appliances, policy)
+        print('Appliances retrieved. {} of {} need changes'.format(
+            len(plan), len(appliances)))
+        print_plan(plan)
+        if plan and not args.dry_run:
+            print('Configuring limits')
+            set_limits(SP_LEADER, API_KEY, plan, args.workers)
 
     print('Done')
 
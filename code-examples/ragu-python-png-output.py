@@ -1,46 +1,167 @@
 from __future__ import print_function
 from sys import stderr
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import argparse
+import urllib.parse
 import requests  # version 2.28.1
 import arrow  # version 1.2.3
-import datetime
+import numpy as np  # version 1.23.3
 import matplotlib  # version 3.6.0
 matplotlib.use('Agg')
 from matplotlib import pyplot as plt
-from matplotlib.dates import DayLocator, HourLocator, DateFormatter, drange
+from matplotlib.dates import DayLocator, HourLocator, DateFormatter, date2num
 import slenv
 
-ALERT_ID = 321334
+ALERT_IDS = [321334]
+# Number of alerts whose router traffic is fetched at the same time
+FETCH_WORKERS = 8
+# Number of processes rendering PNGs; None means one per CPU
+RENDER_WORKERS = None
+# How to reduce long timeseries before plotting them: 'minmax' keeps
+# the low and high point of each bucket, 'lttb' keeps the point of each
+# bucket that forms the largest triangle with its neighbours
+DOWNSAMPLE_METHOD = 'minmax'
+SECONDS_PER_DAY = 86400.0
 
+# Each rendering process builds its figure, axes, locators and
+# formatters once and then reuses them for every graph it draws
+_figure = None
 
-def render_matplotlib_png(alert_router_id, points, start, end, step):
+
+def _get_figure():
+    """Return the figure and line used to render PNGs in this process.
+
+    The figure is created the first time this is called; after that the
+    same figure, axes and line are returned so that only the data and
+    title need to change for each graph.
+
+    Returns:
+        A (figure, axes, line) tuple
+    """
+    global _figure
+    if _figure is None:
+        # using AGG
+        fig = plt.figure(figsize=(10, 6))
+        ax = fig.add_subplot(111)
+        line, = ax.plot_date([], [], '.-')
+        ax.grid(True)
+        # every day
+        ax.xaxis.set_major_locator(DayLocator())
+        # every hour
+        ax.xaxis.set_minor_locator(HourLocator(interval=9))
+        ax.xaxis.set_major_formatter(DateFormatter('%a'))
+        ax.xaxis.set_minor_formatter(DateFormatter('%H:%M'))
+        ax.set_xlabel('time')
+        ax.set_ylabel('bps')
+        _figure = (fig, ax, line)
+    return _figure
+
+
+def _bucket(values, buckets):
+    """Reshape an array into rows of equal size, one row per bucket.
+
+    The last bucket is padded by repeating the final value, so that the
+    padding can never be picked as a new minimum, maximum or peak.
+
+    Args:
+        values: a 1-dimensional numpy array
+        buckets: the number of rows to return
+
+    Returns:
+        A 2-dimensional numpy array with `buckets` rows
+    """
+    size = -(-len(values) // buckets)
+    padded = np.pad(values, (0, size * buckets - len(values)), mode='edge')
+    return padded.reshape(buckets, size)
+
+
+def downsample_minmax(dates, points, target):
+    """Reduce a timeseries to the lowest and highest point per bucket.
+
+    Args:
+        dates: numpy array of matplotlib date numbers
+        points: numpy array of timeseries values
+        target: the maximum number of points to return
+
+    Returns:
+        A (dates, points) tuple of numpy arrays
+    """
+    if len(points) <= target:
+        return dates, points
+    rows = _bucket(points, (target - 2) // 2)
+    offsets = np.arange(rows.shape[0]) * rows.shape[1]
+    keep = np.concatenate((offsets + rows.argmin(axis=1),
+                           offsets + rows.argmax(axis=1),
+                           [0, len(points) - 1]))
+    keep = np.unique(np.minimum(keep, len(points) - 1))
+    return dates[keep], points[keep]
+
+
+def downsample_lttb(dates, points, target):
+    """Reduce a timeseries with largest-triangle-three-buckets.
+
+    The first and last points are always kept; each bucket in between
+    keeps the point that makes the largest triangle with the point kept
+    from the previous bucket and the average of the next bucket.  The
+    work per bucket is done with numpy, so the Python loop runs once per
+    output point, not once per input point.
+
+    Args:
+        dates: numpy array of matplotlib date numbers
+        points: numpy array of timeseries values
+        target: the maximum number of points to return
+
+    Returns:
+        A (dates, points) tuple of numpy arrays
+    """
+    if len(points) <= target or target < 3:
+        return dates, points
+    edges = np.linspace(1, len(points) - 1, target - 1).astype(int)
+    x_means = np.add.reduceat(dates[1:-1], edges[:-1] - 1) / np.diff(edges)
+    y_means = np.add.reduceat(points[1:-1], edges[:-1] - 1) / np.diff(edges)
+    x_means = np.append(x_means, dates[-1])
+    y_means = np.append(y_means, points[-1])
+
+    keep = np.empty(target, dtype=int)
+    keep[0], keep[-1] = 0, len(points) - 1
+    for i in range(target - 2):
+        a = keep[i]
+        xs = dates[edges[i]:edges[i + 1]]
+        ys = points[edges[i]:edges[i + 1]]
+        areas = np.abs((dates[a] - x_means[i + 1]) * (ys - points[a]) -
+                       (dates[a] - xs) * (y_means[i + 1] - points[a]))
+        keep[i + 1] = edges[i] + areas.argmax()
+    return dates[keep], points[keep]
+
+
+def render_matplotlib_png(alert_router_id, points, start, step):
     """Render a graph PNG based on timeseries data using matplotlib.
 
+    Timeseries with more points than the figure is pixels wide are
+    downsampled first, so the time to render a graph and the size of the
+    PNG don't grow with the length of the alert.
+
     Args:
         alert_router_id: a alert_id-router_gid string
         points: timeseries traffic data points
-        start: arrow object representing the start time of the alert
-        end: arrow object reprsenting the end time of the alert
+        start: datetime object representing the start time of the alert
         step: the time period each entry in the timeseries data spans
     """
-    # every day
-    days = DayLocator()
-    # every hour
-    hours = HourLocator(interval=9)
-    delta = datetime.timedelta(seconds=step)
+    fig, ax, line = _get_figure()
+
     # calculate x axis points based on step and start time
-    dates = drange(start, end, delta)
-
-    # using AGG
-    fig = plt.figure(figsize=(10, 6))
-    ax = fig.add_subplot(111)
-    ax.plot_date(dates, points, '.-')
-    ax.grid(True)
-    ax.xaxis.set_major_locator(days)
-    ax.xaxis.set_minor_locator(hours)
-    ax.xaxis.set_major_formatter(DateFormatter('%a'))
-    ax.xaxis.set_minor_formatter(DateFormatter('%H:%M'))
-    ax.set_xlabel('time')
-    ax.set_ylabel('bps')
+    points = np.asarray(points, dtype=float)
+    dates = date2num(start) + np.arange(len(points)) * (step /
+                                                        SECONDS_PER_DAY)
+    target = int(fig.get_figwidth() * fig.dpi)
+    if DOWNSAMPLE_METHOD == 'lttb':
+        dates, points = downsample_lttb(dates, points, target)
+    else:
+        dates, points = downsample_minmax(dates, points, target)
+
+    line.set_data(dates, points)
+    ax.relim()
+    ax.autoscale_view()
     ax.set_title('Router Traffic - {}'.format(alert_router_id))
     fig.autofmt_xdate()
     fig.savefig('{}.png'.format(alert_router_id))
@@ -78,12 +199,51 @@ def api_get_request(url, api_key):
     return api_response['data']
 
 
+def get_alert_ids(sp_leader, api_key, alert_filter):
+    """Get the IDs of the alerts that match an SP filter.
+
+    Args:
+        sp_leader: a valid SP box domain name
+        api_key: API token used to access and use the SP API
+        alert_filter: an SP REST API filter string, for example
+            '/data/attributes/alert_class = dos'
+
+    Returns:
+        A list of alert IDs, from every page of matching alerts
+    """
+    alert_uri = "/api/sp/alerts/?perPage=50&filter={}".format(
+        urllib.parse.quote(alert_filter, safe=''))
+    url = "https://" + sp_leader + alert_uri
+
+    # Follow the "next" links until every page has been read
+    alert_ids = []
+    while url:
+        api_response = requests.get(
+                url,
+                headers={
+                    'X-Arbux-APIToken': api_key,
+                    'Content-Type': 'application/vnd.api+json'
+                },
+                verify=False
+            )
+        if (api_response.status_code < requests.codes.ok or
+                api_response.status_code >= requests.codes.multiple_choices):
+            print("API responded with this error: \n{}".format(
+                api_response.text), file=stderr)
+            break
+        api_response = api_response.json()
+        alert_ids.extend(alert['id'] for alert in api_response['data'])
+        url = api_response.get('links', {}).get('next')
+    return alert_ids
+
+
 def get_alert_traffic_data_router(sp_leader, api_key, alert_id):
     """Get router interface Traffic for alert.
 
     Args:
         sp_leader: a valid SP box domain name
         api_key: API token used to access and use the SP API
+        alert_id: the ID of the alert to get router traffic for
 
     Returns:
         The API response
@@ -96,36 +256,126 @@ def get_alert_traffic_data_router(sp_leader, api_key, alert_id):
     return api_response
 
 
-def graph_timeseries_data_per_router(router_traffic):
-    """Grab appropriate data from API response then build graph.
+def get_alerts_traffic_data_router(sp_leader, api_key, alert_ids):
+    """Get router interface traffic for many alerts at the same time.
+
+    Args:
+        sp_leader: a valid SP box domain name
+        api_key: API token used to access and use the SP API
+        alert_ids: a list of alert IDs
+
+    Returns:
+        A dict of alert ID to the router traffic API response
+    """
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        responses = pool.map(
+            lambda alert_id: get_alert_traffic_data_router(
+                sp_leader, api_key, alert_id),
+            alert_ids)
+        return dict(zip(alert_ids, responses))
+
+
+def graph_jobs_per_router(alert_id, router_traffic):
+    """Grab appropriate data from API response for each graph to build.
 
     Args:
+        alert_id: the ID of the alert the router traffic belongs to, or
+            None to name the graphs for the router alone
         router_traffic: the dict value for 'data' entry of JSON response
+
+    Returns:
+        A list of argument tuples for render_matplotlib_png
     """
+    jobs = []
     if not router_traffic:
-        return
+        return jobs
 
     for router in router_traffic:
         for router_id, view in router['attributes']['view'].items():
             data = view['unit']['bps']
             step = data['step']
-            # Find the end time. Create arrow datetime objects for start and end.
-            start_time = arrow.get(data['timeseries_start'])
-            seconds_after = (step * len(data['timeseries']))
-            start, end = start_time.span('second', count=seconds_after)
-
-            # Build timeseries graph
-            render_matplotlib_png(router_id, data['timeseries'], start, end,
-                                step)
+            # Create an arrow datetime object for the start time
+            start = arrow.get(data['timeseries_start'])
+
+            alert_router_id = router_id
+            if alert_id is not None:
+                alert_router_id = '{}-{}'.format(alert_id, router_id)
+            jobs.append((alert_router_id, data['timeseries'],
+                         start.datetime, step))
+    return jobs
+
+
+def graph_timeseries_data_per_router(router_traffic, alert_id=None):
+    """Grab appropriate data from API response then build graph.
+
+    Args:
+        router_traffic: the dict value for 'data' entry of JSON response
+        alert_id (optional): the ID of the alert the router traffic
+            belongs to; graphs are named for it if supplied
+    """
+    for job in graph_jobs_per_router(alert_id, router_traffic):
+        # Build timeseries graph
+        render_matplotlib_png(*job)
     return
 
 
+def _render_job(job):
+    """Unpack a graph job in a worker process and render it."""
+    render_matplotlib_png(*job)
+    return job[0]
+
+
+def graph_timeseries_data_per_alert(traffic_by_alert):
+    """Build graphs for every alert and router using a process pool.
+
+    Args:
+        traffic_by_alert: a dict of alert ID to the router traffic API
+            response for that alert
+
+    Returns:
+        The number of graphs rendered
+    """
+    jobs = []
+    for alert_id, router_traffic in traffic_by_alert.items():
+        jobs.extend(graph_jobs_per_router(alert_id, router_traffic))
+
+    with ProcessPoolExecutor(max_workers=RENDER_WORKERS) as pool:
+        for alert_router_id in pool.map(_render_job, jobs, chunksize=8):
+            print("  Rendered {}.png".format(alert_router_id))
+    return len(jobs)
+
+
+def parse_cmdline_args():
+    """Parse the command line options and set some useful defaults"""
+    parser = argparse.ArgumentParser(
+        description='Render router traffic PNGs for one or more alerts',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        'alert_ids',
+        nargs='*',
+        default=ALERT_IDS,
+        help='IDs of the alerts to graph')
+    parser.add_argument(
+        '-f', '--filter',
+        dest='alert_filter',
+        help='SP filter selecting the alerts to graph, for example '
+             '"/data/attributes/alert_class = dos"; used instead of '
+             'alert IDs')
+
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
     sp_leader = slenv.leader
     api_key = slenv.apitoken
-    print("Getting traffic data for alert {} ...".format(ALERT_ID))
+    args = parse_cmdline_args()
+    alert_ids = args.alert_ids
+    if args.alert_filter:
+        alert_ids = get_alert_ids(sp_leader, api_key, args.alert_filter)
+    print("Getting traffic data for {} alert(s) ...".format(len(alert_ids)))
     # get router traffic timeseries
-    router_traffic = get_alert_traffic_data_router(sp_leader, api_key, ALERT_ID)
+    traffic_by_alert = get_alerts_traffic_data_router(sp_leader, api_key,
+                                                      alert_ids)
     print("Rendering graph PNGs...")
-    graph_timeseries_data_per_router(router_traffic)
-    print("Done.")
+    rendered = graph_timeseries_data_per_alert(traffic_by_alert)
+    print("Done; rendered {} graph(s).".format(rendered))
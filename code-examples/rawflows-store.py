@@ -0,0 +1,387 @@
+from __future__ import print_function
+import argparse
+import hashlib
+import ipaddress
+import json
+import os
+import shutil
+import socket
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from dateutil.parser import parse
+from dateutil.tz import tzutc
+import numpy as np
+
+# The type each dimension from download-insight-rawflows.py is stored as
+COLUMN_TYPES = {
+    "IP_Protocol": "uint8",
+    "Source_IPv4_Address": "uint32",
+    "Source_Port": "uint16",
+    "Destination_IPv4_Address": "uint32",
+    "Destination_Port": "uint16"
+}
+# Rows without a time are stored in this partition
+NO_TIME_PARTITION = "all"
+SEGMENT_FILE = "segment.json"
+# The most bytes of a CSV file each worker parses at once
+RANGE_SIZE = 64 * 1024 * 1024
+
+
+def parse_cmdline_args():
+    """Parse the command line options and set some useful defaults"""
+    parser = argparse.ArgumentParser(
+        description='Load raw flows CSV files into a local store and '
+                    'query it',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '-d', '--store_dir',
+        default='./rawflows-store',
+        dest='store_dir',
+        help='Directory holding the raw flows store')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    ingest = subparsers.add_parser(
+        'ingest', help='Add raw flows CSV files to the store',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    ingest.add_argument(
+        'csv_files',
+        nargs='+',
+        help='Raw flows CSV files written by download-insight-rawflows.py')
+    ingest.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=os.cpu_count(),
+        dest='workers',
+        help='Number of processes parsing the files')
+    ingest.add_argument(
+        '-t', '--time_column',
+        default='Start_Time',
+        dest='time_column',
+        help='CSV column used to partition flows by hour (the time '
+             'dimension download-insight-rawflows.py asks for); if a file '
+             'does not have it, its flows go in the "{}" partition'.format(
+                 NO_TIME_PARTITION))
+
+    query = subparsers.add_parser(
+        'query', help='Count or print the stored flows that match',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    query.add_argument('--src', dest='src',
+                       help='Source address or CIDR block')
+    query.add_argument('--dst', dest='dst',
+                       help='Destination address or CIDR block')
+    query.add_argument('--src_port', type=int, dest='src_port',
+                       help='Source port')
+    query.add_argument('--dst_port', type=int, dest='dst_port',
+                       help='Destination port')
+    query.add_argument('--proto', type=int, dest='proto',
+                       help='IP protocol number')
+    query.add_argument('-s', '--start_time', dest='start',
+                       help='Only search hours from this time onwards '
+                            '(UTC unless it has an offset)')
+    query.add_argument('-e', '--end_time', dest='end',
+                       help='Only search hours up to this time (UTC '
+                            'unless it has an offset)')
+    query.add_argument('-p', '--print', action='store_true', dest='print',
+                       help='Print the matching flows as CSV')
+
+    return parser.parse_args()
+
+
+def ipv4_to_int(address):
+    """Convert a dotted-quad IPv4 address in bytes to an integer"""
+    try:
+        return struct.unpack("!I", socket.inet_aton(address.decode()))[0]
+    except (OSError, UnicodeDecodeError):
+        return 0
+
+
+def to_array(values, dtype):
+    """Convert a list of CSV fields in bytes to a numpy array of dtype"""
+    if dtype == "uint32":
+        return np.fromiter((ipv4_to_int(v) for v in values),
+                           dtype=np.uint32, count=len(values))
+    array = np.array(values)
+    array[array == b""] = b"0"
+    return array.astype(dtype)
+
+
+def to_utc(when):
+    """Parse a time into an aware UTC datetime
+
+    Times may be seconds since the epoch or anything dateutil can parse;
+    times without an offset are taken to be UTC.
+    """
+    try:
+        return datetime.fromtimestamp(float(when), tzutc())
+    except ValueError:
+        when = parse(when)
+    if when.tzinfo is None:
+        return when.replace(tzinfo=tzutc())
+    return when.astimezone(tzutc())
+
+
+def partition_name(when):
+    """Return the name of the UTC hour partition for an aware datetime"""
+    return when.strftime("%Y-%m-%dT%H")
+
+
+def to_partitions(values):
+    """Convert a list of CSV time fields to hour partition names
+
+    Every time is converted to UTC first, so the same moment goes in the
+    same partition whatever format or offset it was written with; each
+    distinct value is only converted once.
+    """
+    unique, inverse = np.unique(np.array(values), return_inverse=True)
+    names = [partition_name(to_utc(value.decode())) for value in unique]
+    return np.array(names)[inverse]
+
+
+def read_header(filename):
+    """Return the header row of a CSV file and its length in bytes"""
+    with open(filename, "rb") as f:
+        header = f.readline()
+    names = [title.decode().strip().strip('"').replace(" ", "_")
+             for title in header.rstrip(b"\r\n").split(b",")]
+    return names, len(header)
+
+
+def split_ranges(filename, start, range_size=RANGE_SIZE):
+    """Split a file into byte ranges that each end at a row boundary
+
+    Each range is about range_size bytes (longer only by the rest of
+    the row it would end in), however big the file is, so a worker
+    never has more than that much of it in memory.
+
+    Args:
+        filename: the CSV file to split
+        start: the offset of the first row after the header
+        range_size: the number of bytes to put in each range
+
+    Returns:
+        A list of (start, end) byte offsets
+    """
+    size = os.path.getsize(filename)
+    bounds = [start]
+    with open(filename, "rb") as f:
+        while bounds[-1] + range_size < size:
+            f.seek(bounds[-1] + range_size)
+            f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def segment_prefix(filename):
+    """Return the start of the names of a CSV file's segments
+
+    The name includes a hash of the file's absolute path so files with
+    the same name in different directories don't overwrite each other.
+    """
+    path = os.path.abspath(filename)
+    return "{}-{}-".format(os.path.basename(path),
+                           hashlib.sha1(path.encode()).hexdigest()[:12])
+
+
+def remove_segments(store_dir, filename):
+    """Remove the segments stored from a CSV file by an earlier ingest"""
+    if not os.path.isdir(store_dir):
+        return
+    prefix = segment_prefix(filename)
+    for partition in os.listdir(store_dir):
+        partition_dir = os.path.join(store_dir, partition)
+        for segment in os.listdir(partition_dir):
+            if segment.startswith(prefix):
+                shutil.rmtree(os.path.join(partition_dir, segment))
+
+
+def ingest_range(store_dir, filename, names, time_column, part, start, end):
+    """Parse one byte range of a CSV file into hour-partitioned segments
+
+    Each hour seen in the range gets its own segment directory holding
+    one binary file per column and a segment.json with the number of
+    rows and the smallest and largest value of every column, which
+    queries use to skip segments that can't match.
+
+    Returns:
+        The number of rows stored
+    """
+    with open(filename, "rb") as f:
+        f.seek(start)
+        lines = f.read(end - start).split(b"\n")
+    rows = [line.rstrip(b"\r").split(b",") for line in lines if line]
+    if not rows:
+        return 0
+
+    columns = {name: to_array([row[names.index(name)] for row in rows],
+                              dtype)
+               for name, dtype in COLUMN_TYPES.items() if name in names}
+    if time_column in names:
+        partitions = to_partitions([row[names.index(time_column)]
+                                    for row in rows])
+    else:
+        partitions = np.full(len(rows), NO_TIME_PARTITION)
+
+    segment_name = "{}{}".format(segment_prefix(filename), part)
+    for partition in np.unique(partitions):
+        selected = partitions == partition
+        segment_dir = os.path.join(store_dir, partition, segment_name)
+        if not os.path.isdir(segment_dir):
+            os.makedirs(segment_dir)
+        stats = {"rows": int(selected.sum()), "columns": {}}
+        for name, values in columns.items():
+            values = values[selected]
+            values.tofile(os.path.join(segment_dir, name + ".bin"))
+            stats["columns"][name] = {"dtype": COLUMN_TYPES[name],
+                                      "min": int(values.min()),
+                                      "max": int(values.max())}
+        with open(os.path.join(segment_dir, SEGMENT_FILE), "w") as f:
+            json.dump(stats, f)
+    return len(rows)
+
+
+def ingest(store_dir, csv_files, workers, time_column):
+    """Parse CSV files into the store with a pool of processes
+
+    A file that was ingested before replaces its old segments, however
+    many pieces it was split into then.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for filename in csv_files:
+            remove_segments(store_dir, filename)
+            names, header_size = read_header(filename)
+            for part, (start, end) in enumerate(
+                    split_ranges(filename, header_size)):
+                futures.append(pool.submit(ingest_range, store_dir,
+                                           filename, names, time_column,
+                                           part, start, end))
+        return sum(future.result() for future in futures)
+
+
+def cidr_range(cidr):
+    """Return the first and last address of a CIDR block as integers"""
+    network = ipaddress.IPv4Network(cidr, strict=False)
+    return int(network.network_address), int(network.broadcast_address)
+
+
+def build_filters(args):
+    """Turn the query options into (column, lowest, highest) ranges"""
+    filters = []
+    for option, name in (("src", "Source_IPv4_Address"),
+                         ("dst", "Destination_IPv4_Address")):
+        if getattr(args, option):
+            low, high = cidr_range(getattr(args, option))
+            filters.append((name, low, high))
+    for option, name in (("src_port", "Source_Port"),
+                         ("dst_port", "Destination_Port"),
+                         ("proto", "IP_Protocol")):
+        if getattr(args, option) is not None:
+            filters.append((name, getattr(args, option),
+                            getattr(args, option)))
+    return filters
+
+
+def partitions_in_range(store_dir, start, end):
+    """List the hour partitions between start and end
+
+    The hour that end falls in is included unless end is exactly on the
+    hour.  Both are converted to UTC like the times of the flows.  The
+    partition of flows without a time is always included.
+    """
+    first = partition_name(to_utc(start)) if start else None
+    last = None
+    if end:
+        end = to_utc(end)
+        last = partition_name(end)
+        on_the_hour = end == end.replace(minute=0, second=0, microsecond=0)
+    for partition in sorted(os.listdir(store_dir)):
+        if partition != NO_TIME_PARTITION:
+            if first and partition < first:
+                continue
+            if last and (partition > last or
+                         partition == last and on_the_hour):
+                continue
+        yield partition
+
+
+def query(store_dir, filters, start=None, end=None, print_rows=False):
+    """Scan the segments that can match the filters
+
+    Segments whose smallest and largest values show that no row can
+    match are skipped without being read; the rest are memory-mapped
+    and filtered with numpy.
+
+    Returns:
+        The number of matching flows, segments scanned, and segments
+        skipped
+    """
+    matches = scanned = skipped = 0
+    if print_rows:
+        print(",".join(COLUMN_TYPES))
+    for partition in partitions_in_range(store_dir, start, end):
+        partition_dir = os.path.join(store_dir, partition)
+        for segment in sorted(os.listdir(partition_dir)):
+            segment_dir = os.path.join(partition_dir, segment)
+            with open(os.path.join(segment_dir, SEGMENT_FILE)) as f:
+                stats = json.load(f)
+            if any(name not in stats["columns"] or
+                   stats["columns"][name]["max"] < low or
+                   stats["columns"][name]["min"] > high
+                   for name, low, high in filters):
+                skipped += 1
+                continue
+            scanned += 1
+
+            columns = {name: np.memmap(os.path.join(segment_dir,
+                                                    name + ".bin"),
+                                       dtype=column["dtype"], mode="r",
+                                       shape=(stats["rows"],))
+                       for name, column in stats["columns"].items()}
+            mask = np.ones(stats["rows"], dtype=bool)
+            for name, low, high in filters:
+                mask &= (columns[name] >= low) & (columns[name] <= high)
+            matches += int(mask.sum())
+
+            if print_rows:
+                selected = [columns[name][mask] if name in columns else
+                            np.zeros(int(mask.sum()), dtype=np.uint8)
+                            for name in COLUMN_TYPES]
+                for row in zip(*selected):
+                    print(",".join(
+                        socket.inet_ntoa(struct.pack("!I", value))
+                        if dtype == "uint32" else str(value)
+                        for value, dtype in zip(row,
+                                                COLUMN_TYPES.values())))
+    return matches, scanned, skipped
+
+
+if __name__ == '__main__':
+
+    args = parse_cmdline_args()
+
+    if args.command == 'ingest':
+        ingest_start = datetime.now()
+        rows = ingest(args.store_dir, args.csv_files, args.workers,
+                      args.time_column)
+        print("Stored {} flows from {} file(s) in {:.1f} seconds".format(
+            rows, len(args.csv_files),
+            (datetime.now() - ingest_start).total_seconds()))
+    else:
+        if not os.path.isdir(args.store_dir):
+            print("ERROR: there is no store in {}".format(args.store_dir),
+                  file=sys.stderr)
+            sys.exit(1)
+        query_start = datetime.now()
+        matches, scanned, skipped = query(args.store_dir, build_filters(args),
+                                          args.start, args.end, args.print)
+        print("{} matching flows; {} segments scanned, {} skipped, in "
+              "{:.3f} seconds".format(
+                  matches, scanned, skipped,
+                  (datetime.now() - query_start).total_seconds()),
+              file=sys.stderr if args.print else sys.stdout)
@@ -6,12 +6,21 @@ This requires Sightline 9.0 or greater with Insight 6 or greater.
 
 """
 from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
 import json
 import os
 import requests
 import sys
 
 CERT_FILE = "./certfile"
+# how many alerts to get in each page
+PER_PAGE = 50
+# how many pages of alerts to request at the same time
+PAGE_WORKERS = 4
+# traffic is checked in five minute windows, so a smart alert can start up
+# to this long before its smart alert setting was created
+SMART_ALERT_WINDOW = timedelta(minutes=5)
 
 SMART_ALERT_SETTING_BODY = {
     "data": {
@@ -111,40 +120,30 @@ def post_smart_alert_setting(leader, key):
     return data.get('id', None)
 
 
-def get_triggered_smart_alerts(leader, key, smart_alert_setting_id,
-                               triggered_smart_alerts=[], page=1):
-    """Get the smart alert triggered with the given smart alert setting id
-
-    This is in this example to show that the smart alert setting was created
-        with the correct attributes.
+def get_smart_alert_page(leader, key, page, since=None):
+    """Get one page of smart alerts
 
     Args:
-        leader(string): box to use to create the smart alert setting
-        key(string): an API token granting permission to POST a smart alert on
-            the given leader.
-        smart_alert_setting_id(string): id of the smart alert setting to get
-        triggered_smart_alerts(list(string)): ids of smart alerts triggered by
-            the given smart alert setting
-        page(int): current page of alerts
+        leader(string): box to get the smart alerts from
+        key(string): an API token granting permission to GET alerts on the
+            given leader.
+        page(int): the page of alerts to get
+        since(string): if given, only get alerts that started after this
+            ISO 8601 time
 
     Returns:
-        list(string): the ids of the triggered alerts
+        list(dict): the alerts on the page, or None if the request failed
     """
-    # Python quirk
-    if triggered_smart_alerts is None:
-        triggered_smart_alerts = []
-
     # build the URL, filtering on only smart alerts (of type smart_thresh)
-    URL = ('https://{leader}/api/sp/alerts/?'
-           'filter=/data/attributes/alert_type=smart_thresh&'
-           'page={page}').format(
-        leader=leader,
-        resource=smart_alert_setting_id,
-        page=page)
+    URL = 'https://{leader}/api/sp/alerts/'.format(leader=leader)
+    alert_filter = '/data/attributes/alert_type=smart_thresh'
+    if since is not None:
+        alert_filter += ' AND /data/attributes/start_time > {}'.format(since)
 
     # make the API request
     api_response = requests.get(
         URL,
+        params={'filter': alert_filter, 'perPage': PER_PAGE, 'page': page},
         headers={
             'X-Arbux-APIToken': key,
             'Content-Type': 'application/vnd.api+json'
@@ -155,30 +154,112 @@ def get_triggered_smart_alerts(leader, key, smart_alert_setting_id,
     if api_response.status_code != requests.codes.ok:
         print("[GET ERROR] API responded with this error: "
               "{}\n(url: {})".
-              format(api_response.reason, URL),
+              format(api_response.reason, api_response.url),
               file=sys.stderr)
         return None
 
     # convert the response to JSON and get the 'data' element
-    api_response = api_response.json()
-    data = api_response['data']
-    if data == []:
-        # No more results
-        return triggered_smart_alerts
+    return api_response.json()['data']
+
+
+def index_triggered_smart_alerts(leader, key, smart_alert_setting_ids,
+                                 since=None, workers=PAGE_WORKERS):
+    """Find the smart alerts triggered by each of several smart alert settings
+
+    The pages of smart alerts are read once for all of the settings.  Up to
+        `workers` pages are requested at the same time, and each page that
+        comes back with alerts on it starts the request for the next page
+        that hasn't been asked for yet, until a page comes back empty.
+
+    Args:
+        leader(string): box to get the smart alerts from
+        key(string): an API token granting permission to GET alerts on the
+            given leader.
+        smart_alert_setting_ids(list(string)): ids of the smart alert
+            settings to look for
+        since(string): if given, only look at alerts that started after
+            this ISO 8601 time
+        workers(int): the most pages to request at the same time
+
+    Returns:
+        dict: the ids of the triggered alerts (in the order the API lists
+            them) for each smart alert setting id, or None if a request
+            failed
+    """
+    wanted = set(smart_alert_setting_ids)
+    matches = {}
+    last_page = None
+    failed = False
 
-    for resource in data:
-        if ('relationships' in resource and
-                'smart_alert_setting' in resource['relationships']):
-            id_ = (resource['relationships']
-                   ['smart_alert_setting']['data']['id'])
-            if id_ == smart_alert_setting_id:
-                triggered_smart_alerts.append(resource['id'])
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {pool.submit(get_smart_alert_page, leader, key, page,
+                               since): page
+                   for page in range(1, workers + 1)}
+        next_page = workers + 1
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                page = running.pop(future)
+                data = future.result()
+                if data is None:
+                    failed = True
+                    continue
+                if data == []:
+                    # No more results
+                    if last_page is None or page < last_page:
+                        last_page = page
+                    continue
 
-    # iterate over pages of alerts to find the triggered alert with the given
-    # smart alert setting
-    page += 1
-    return get_triggered_smart_alerts(
-        leader, key, smart_alert_setting_id, triggered_smart_alerts, page)
+                # keep only the alerts triggered by the wanted settings
+                matches[page] = []
+                for resource in data:
+                    setting = (resource.get('relationships', {})
+                               .get('smart_alert_setting', {})
+                               .get('data') or {})
+                    if setting.get('id') in wanted:
+                        matches[page].append((setting['id'],
+                                              resource['id']))
+
+                if last_page is None and not failed:
+                    running[pool.submit(get_smart_alert_page, leader, key,
+                                        next_page, since)] = next_page
+                    next_page += 1
+
+    if failed:
+        return None
+
+    triggered_smart_alerts = {id_: [] for id_ in smart_alert_setting_ids}
+    for page in sorted(matches):
+        if last_page is not None and page > last_page:
+            continue
+        for id_, alert_id in matches[page]:
+            triggered_smart_alerts[id_].append(alert_id)
+    return triggered_smart_alerts
+
+
+def get_triggered_smart_alerts(leader, key, smart_alert_setting_id,
+                               since=None):
+    """Get the smart alert triggered with the given smart alert setting id
+
+    This is in this example to show that the smart alert setting was created
+        with the correct attributes.
+
+    Args:
+        leader(string): box to use to create the smart alert setting
+        key(string): an API token granting permission to POST a smart alert on
+            the given leader.
+        smart_alert_setting_id(string): id of the smart alert setting to get
+        since(string): if given, only look at alerts that started after
+            this ISO 8601 time
+
+    Returns:
+        list(string): the ids of the triggered alerts
+    """
+    triggered_smart_alerts = index_triggered_smart_alerts(
+        leader, key, [smart_alert_setting_id], since)
+    if triggered_smart_alerts is None:
+        return None
+    return triggered_smart_alerts[smart_alert_setting_id]
 
 
 if __name__ == '__main__':
@@ -198,6 +279,7 @@ if __name__ == '__main__':
     # Create a smart_alert_setting
     #
     print("Creating a new smart alert on {}.".format(SP_LEADER))
+    created = datetime.utcnow()
     smart_alert_setting_id = post_smart_alert_setting(
         SP_LEADER, API_KEY)
 
@@ -207,10 +289,13 @@ if __name__ == '__main__':
     # smart_alert_setting and the smart alert. For the purposes of this example
     # we assume that the time has passed and that the traffic has met the
     # required settings, such that a smart alert is actually triggered.
+    # Only alerts that started after the smart alert setting was created
+    # (less one traffic window) can have been triggered by it.
     #
     print("Checking for smart alerts.")
+    since = (created - SMART_ALERT_WINDOW).strftime('%Y-%m-%dT%H:%M:%S+00:00')
     smart_alert_ids = get_triggered_smart_alerts(
-        SP_LEADER, API_KEY, smart_alert_setting_id)
+        SP_LEADER, API_KEY, smart_alert_setting_id, since)
 
     print("Created Smart Alert Setting: {}.".format(smart_alert_setting_id))
     if smart_alert_ids:
@@ -7,21 +7,97 @@ data that can be used to build the relationship between Source IP address,
 Source Port, Destination Port, and Destination IP address with traffic flow
 rates represented on each link.
 
-The two non-standard Python packages required are:
+Before anything is added to the graph, the rows are grouped by each pair of
+adjacent relationships and their traffic is summed, keeping only the `TOP_K`
+busiest values of each relationship and the `TOP_K` busiest edges between each
+pair, with everything else sent to an "Other" node, so large `limit` values
+still produce a readable graph quickly.
+
+The query is run with `insight_topn.py` (which must be in the same directory)
+as one query per destination port, all sent at the same time, and the results
+are merged before the graph is built.
+
+The three non-standard Python packages required are:
   - requests; http://docs.python-requests.org/
   - networkx: https://networkx.github.io/
+  - numpy: https://numpy.org/
 
 And you will need the `dot` package from Graphviz (http://graphviz.org/) to
 convert the output of this script into a graphical representation of the
 traffic """
 
 from __future__ import print_function
-import requests
-import json
 import networkx as nx
-import sys
+import numpy as np
 import os
 from networkx.drawing.nx_pydot import write_dot
+import insight_topn
+
+# The number of values of each relationship, and the number of edges between
+# each pair of relationships, to show before grouping the rest as "Other"
+TOP_K = 10
+OTHER = "Other"
+
+
+def collapse_values(values, weights, top_k):
+    """Number each distinct value, keeping only the top_k by weight
+
+    Returns a tuple of the kept values (with OTHER last if any were dropped)
+    and, for each row, the index of its value in that array
+    """
+    unique, codes = np.unique(values, return_inverse=True)
+    codes = codes.ravel()
+    if len(unique) <= top_k:
+        return unique, codes
+    totals = np.bincount(codes, weights=weights, minlength=len(unique))
+    keep = np.argsort(totals)[::-1][:top_k]
+    remap = np.full(len(unique), top_k)
+    remap[keep] = np.arange(top_k)
+    return np.append(unique[keep], OTHER), remap[codes]
+
+
+def aggregate_edges(rows, relationships, metric, top_k):
+    """Sum the traffic between each pair of adjacent relationships
+
+    Each relationship keeps its top_k values by traffic and the rest become
+    OTHER; then each layer of edges keeps its top_k edges by traffic.  The
+    traffic of each edge that is dropped is added to an edge from its from
+    value to OTHER (or, if the from value is already OTHER, from OTHER to its
+    to value), so no traffic is lost and the traffic leaving each kept value
+    still adds up.
+
+    Returns a list with one list of (from value, to value, traffic) tuples
+    for each pair of adjacent relationships, with no pair repeated
+    """
+    if not rows:
+        return []
+    weights = np.array([row[metric]['average']['total'] for row in rows],
+                       dtype=float)
+    columns = [collapse_values(np.array([row[name] for row in rows]),
+                               weights, top_k)
+               for name in relationships]
+
+    layers = []
+    for (from_values, from_codes), (to_values, to_codes) in zip(columns,
+                                                                columns[1:]):
+        pairs, inverse = np.unique(from_codes * len(to_values) + to_codes,
+                                   return_inverse=True)
+        totals = np.bincount(inverse.ravel(), weights=weights)
+        order = np.argsort(totals)[::-1]
+        layer = {}
+        for rank, index in enumerate(order):
+            from_value = str(from_values[pairs[index] // len(to_values)])
+            to_value = str(to_values[pairs[index] % len(to_values)])
+            if rank >= top_k:
+                if from_value != OTHER:
+                    to_value = OTHER
+                else:
+                    from_value = OTHER
+            edge = (from_value, to_value)
+            layer[edge] = layer.get(edge, 0.0) + float(totals[index])
+        layers.append([(from_value, to_value, total)
+                       for (from_value, to_value), total in layer.items()])
+    return layers
 
 
 if __name__ == '__main__':
@@ -75,54 +151,35 @@ if __name__ == '__main__':
         "calculation": "average"
     }
 
-    # create the URL for our Insight UI device
-    url = 'https://{}/api/sp/insight/topn'.format(insight_pi)
-
-    # POST the query and get the results
-    r = requests.post(
-        url,
-        headers={
-            "X-Arbux-APIToken": api_token,
-            "Content-Type": 'application/json'
-        },
-        json=query,
-        verify='./certfile')
-
-    # make sure we got results, otherwise print what the error to the screen
-    if r.status_code != requests.codes.ok:
-        print(json.dumps(r.json()))
-        sys.exit(1)
-
-    # Convert the results to json
-    rj = r.json()
+    # POST one query for each destination port at the same time and merge
+    # the results; insight_topn prints the error and exits if a query fails
+    rows, per_port = insight_topn.fan_out_topn(insight_pi, api_token, query,
+                                               split='selectors')
+    rj = {'data': rows}
 
     # Set up a directed graph using networkx
     G = nx.DiGraph()
 
-    # Go through the results JSON and look at each key in it that is also in
-    # the `relationships_lr` list, creating a FROM and a TO node, label them
-    # with their type (from the `labels` list), create the edge between them
-    # with either a new weight (traffic rate) or add to the existing weight
-    # (traffic rate)
+    # Sum the traffic (weight) between each pair of adjacent keys in the
+    # `relationships_lr` list, then create a FROM and a TO node for each
+    # edge, label them with their type (from the `labels` list), and create
+    # the edge between them with its weight
     node_shape = "box"
-    for rel in rj['data']:
-        for edge_num in range(len(relationships_lr)-1):
-            from_ = (relationships_lr[edge_num] + "_" +
-                     rel[relationships_lr[edge_num]])
-            to = (relationships_lr[edge_num+1] + "_" +
-                  rel[relationships_lr[edge_num+1]])
+    layers = aggregate_edges(rj['data'], relationships_lr, query['metric'],
+                             TOP_K)
+    for edge_num, layer in enumerate(layers):
+        for from_value, to_value, weight in layer:
+            from_ = relationships_lr[edge_num] + "_" + from_value
+            to = relationships_lr[edge_num+1] + "_" + to_value
             G.add_node(from_, label="{}\n{}".format(
-                labels_lr[edge_num],
-                rel[relationships_lr[edge_num]]),
+                labels_lr[edge_num], from_value),
                 shape=node_shape)
             G.add_node(to, label="{}\n{}".format(
-                labels_lr[edge_num+1],
-                rel[relationships_lr[edge_num+1]]),
+                labels_lr[edge_num+1], to_value),
                 shape=node_shape)
             if G.has_edge(from_, to):
-                G[from_][to]['weight'] += rel['bps']['average']['total']
-            else:
-                G.add_edge(from_, to, weight=rel['bps']['average']['total'])
+                weight += G[from_][to]['weight']
+            G.add_edge(from_, to, weight=int(weight))
 
     # compute the line widths based on the edge weights and the thickest
     # allowed line
@@ -141,5 +198,10 @@ if __name__ == '__main__':
     # print some information to the screen
     print ("Insight PI: {}".format(insight_pi))
     print ("There are {} things in the response".format(len(rj['data'])))
+    for port_query, port_rows in per_port:
+        print ("  {} things for {} {}".format(
+            len(port_rows),
+            port_query['filters']['fields'][0]['facet'],
+            port_query['filters']['fields'][0]['value']))
     print ("Start Time: {}".format(query['start']))
     print ("  End Time: {}".format(query['end']))
@@ -1,12 +1,62 @@
 from __future__ import print_function
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from sys import stderr
 import requests
+import argparse
 import json
+import operator
+import os
+import time
 import urllib.parse
 import slenv
 
 CERT_FILE = './certfile'
+# One session for every request, so its connections to the leader are
+# kept open and reused between polls
+SESSION = requests.Session()
+# How far back to look for alerts; daemon mode keeps its watermark at
+# least this far behind now, so an alert that starts out not matching the
+# rules (for example at Low importance) and is escalated within this time
+# is still found and mitigated
+LOOKBACK = timedelta(minutes=15)
+# How many alerts to ask for in each request
+PER_PAGE = 100
+# Where daemon mode keeps its watermark and the alerts it has mitigated
+STATE_FILE = './auto-mitigation-state.json'
+# How many seconds daemon mode waits between polls
+POLL_INTERVAL = 5
+# How far before an alert whose mitigation couldn't be started the next
+# poll starts, so it is tried again
+WATERMARK_OVERLAP = timedelta(minutes=2)
+# The most mitigations that are started at the same time
+MITIGATION_WORKERS = 8
+# Rules are read from this file (JSON, or YAML if PyYAML is installed and
+# the name ends in .yaml or .yml); DEFAULT_RULES are used if it is missing
+RULES_FILE = './mitigation-rules.json'
+# Mitigate alerts that are High importance, ongoing, and DoS Host alerts
+DEFAULT_RULES = [
+	{
+		"name": "High importance ongoing DoS Host alerts",
+		"match": {
+			"importance": 2,
+			"ongoing": True,
+			"alert_type": "dos_host_detection"
+		}
+	}
+]
+OPERATORS = {
+	'=': operator.eq,
+	'!=': operator.ne,
+	'<': operator.lt,
+	'<=': operator.le,
+	'>': operator.gt,
+	'>=': operator.ge,
+	'in': lambda actual, wanted: actual in wanted
+}
+# The operators the SP filter language can evaluate on the leader
+PUSHDOWN_OPERATORS = ('=', '<', '>')
+MISSING = object()
 
 
 def api_request(URL, key, body=None):
@@ -18,7 +68,7 @@ def api_request(URL, key, body=None):
 
     api_response = None
     if body is None:
-        api_response = requests.get(
+        api_response = SESSION.get(
 			URL,
 			headers={'X-Arbux-APIToken':
 					key,
@@ -26,7 +76,7 @@ def api_request(URL, key, body=None):
 					'application/vnd.api+json'},
 			verify=CERT_FILE)
     else:
-        api_response = requests.post(
+        api_response = SESSION.post(
 			URL,
 			data=body,
 			headers={'X-Arbux-APIToken':
@@ -50,10 +100,16 @@ def api_request(URL, key, body=None):
     return api_response['data']
 
 
-def get_alerts(leader, key, period):
+def get_alerts(leader, key, period, pushdown=''):
     """Define a function for retrieving
     alerts from an SP Leader
 
+    Any conditions in pushdown are added to the
+    filter, so the leader only returns alerts that
+    can match the rules.  Every page is read,
+    following the "next" links, and None is returned
+    if any of them can't be read
+
     """
 
     timefmt = '%a %b %d %H:%M:%S %Y'
@@ -66,19 +122,215 @@ def get_alerts(leader, key, period):
     # Craft the URL components, filtering
     # based on time period
 
-    ALERT_URI = "/api/sp/alerts/?filter="
+    ALERT_URI = "/api/sp/alerts/?perPage={}&filter=".format(PER_PAGE)
     FILTER = "/data/attributes/start_time > " + iso_time
+    if pushdown:
+        FILTER += " AND " + pushdown
 
     # Percent-encode our filter query and combine URL components
     FILTER = urllib.parse.quote(FILTER, safe='')
     URL = "https://" + leader + ALERT_URI + FILTER
 
-    # Make the api request and return its results
-    api_response = api_request(URL, key)
-    return api_response
+    # Make the api requests, one for each page, and return their results
+    alerts = []
+    while URL:
+        api_response = SESSION.get(
+			URL,
+			headers={'X-Arbux-APIToken':
+					key,
+					'Content-Type':
+					'application/vnd.api+json'},
+			verify=CERT_FILE)
+        if api_response.status_code != requests.codes.ok:
+            print("API responded with this error: \n{}"
+				  .format(api_response.text),
+				  file=stderr)
+            return None
+        api_response = api_response.json()
+        alerts.extend(api_response['data'])
+        URL = api_response.get('links', {}).get('next')
+    return alerts
+
+
+def load_rules(filename):
+    """Define a function for reading the
+    mitigation rules
+
+    Each rule has a name and a match of alert
+    attributes (nested ones are written like
+    subobject/ip_version) to the value they must
+    have, or to a dict of operator to value, for
+    example {"severity_percent": {">": 200}}; an
+    alert is mitigated if it matches any rule
+
+    """
+
+    if not os.path.exists(filename):
+        return DEFAULT_RULES
+    with open(filename) as rules_file:
+        if filename.endswith(('.yaml', '.yml')):
+            import yaml  # PyYAML is only needed for YAML rules
+            return yaml.safe_load(rules_file)
+        return json.load(rules_file)
+
+
+def hashable(value):
+    """Define a function for turning lists in
+    rules into tuples so conditions can be
+    compared and indexed
+
+    """
+
+    if isinstance(value, list):
+        return tuple(hashable(item) for item in value)
+    return value
+
+
+def rule_conditions(rule):
+    """Define a function for turning a rule
+    into a set of (path, operator, value)
+    conditions
+
+    """
+
+    conditions = set()
+    for path, wanted in rule['match'].items():
+        if not isinstance(wanted, dict):
+            wanted = {'=': wanted}
+        for op, value in wanted.items():
+            if op not in OPERATORS:
+                raise ValueError("Rule '{}' has an unknown operator: {}"
+								 .format(rule['name'], op))
+            conditions.add((path, op, hashable(value)))
+    return conditions
+
+
+def make_getter(path):
+    """Define a function for making a function
+    that gets an alert attribute, or MISSING
+
+    """
+
+    keys = path.split('/')
 
+    def getter(attributes):
+        value = attributes
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                return MISSING
+            value = value[key]
+        return value
+    return getter
 
-def apply_rules(alerts):
+
+def compile_condition(path, op, value):
+    """Define a function for making a
+    predicate function for one condition
+
+    """
+
+    getter = make_getter(path)
+    compare = OPERATORS[op]
+
+    def predicate(attributes):
+        actual = getter(attributes)
+        if actual is MISSING:
+            return False
+        try:
+            return compare(actual, value)
+        except TypeError:
+            return False
+    return predicate
+
+
+def filter_value(value):
+    """Define a function for writing a value
+    the way the SP filter language expects
+
+    """
+
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def compile_rules(rules):
+    """Define a function for compiling rules
+    into a filter for the leader and a fast
+    function that matches alerts
+
+    An alert must match all of the conditions of at
+    least one rule, so a condition that is in every
+    rule and that the SP filter language can express
+    is sent to the leader in the filter, and only the
+    other conditions are checked here.  The rules are
+    also indexed by the value of the attribute most
+    of them test for equality, so each alert is only
+    checked against the rules that can match it.
+
+    Returns a filter string and a function that
+    returns the name of the first rule an alert
+    matches, or None
+
+    """
+
+    conditions = [rule_conditions(rule) for rule in rules]
+    common = set.intersection(*conditions) if conditions else set()
+    pushed = sorted(
+		(path, op, value) for path, op, value in common
+		if op in PUSHDOWN_OPERATORS and
+		isinstance(value, (bool, int, float, str)))
+    pushdown = " AND ".join(
+		"/data/attributes/{} {} {}".format(path, op, filter_value(value))
+		for path, op, value in pushed)
+
+    remaining = [set(rule) - set(pushed) for rule in conditions]
+
+    # Index the rules by the equality condition most of them have
+    equality_paths = {}
+    for rule in remaining:
+        for path in set(path for path, op, _ in rule if op == '='):
+            equality_paths[path] = equality_paths.get(path, 0) + 1
+    index_path = (max(equality_paths, key=equality_paths.get)
+				  if equality_paths else None)
+
+    indexed = {}
+    unindexed = []
+    for rule, rule_remaining in zip(rules, remaining):
+        index_value = MISSING
+        for path, op, value in rule_remaining:
+            if path == index_path and op == '=':
+                index_value = value
+        checks = tuple(compile_condition(*condition)
+					   for condition in rule_remaining
+					   if (condition[0], condition[1]) !=
+					   (index_path, '=') or index_value is MISSING)
+        compiled = (rule['name'], checks)
+        if index_value is MISSING:
+            unindexed.append(compiled)
+        else:
+            indexed.setdefault(index_value, []).append(compiled)
+
+    index_getter = make_getter(index_path) if index_path else None
+
+    def match(alert):
+        attributes = alert['attributes']
+        candidates = unindexed
+        if index_getter is not None:
+            try:
+                candidates = (indexed.get(hashable(index_getter(attributes)),
+										  []) + unindexed)
+            except TypeError:
+                pass
+        for name, checks in candidates:
+            if all(check(attributes) for check in checks):
+                return name
+        return None
+
+    return pushdown, match
+
+
+def apply_rules(alerts, match):
     """Define a function for filtering
     alerts based on rules
 
@@ -86,13 +338,9 @@ def apply_rules(alerts):
 
     filtered_alerts = []
 
-    # Return alerts that match the following rules:
-    # Importance = High, Ongoing = True, Alert Type = DOS
+    # Return alerts that match any of the compiled rules
     for alert in alerts:
-        attributes = alert['attributes']
-        if (attributes['importance'] == 2 and
-				attributes['ongoing'] is True and
-				attributes['alert_type'] == 'dos_host_detection'):
+        if match(alert) is not None:
             filtered_alerts.append(alert)
 
     print("{} alert(s) match mitigation criterion"
@@ -134,67 +382,272 @@ def extract_mitigation_attr(alert):
     return attributes
 
 
-def mitigate(leader, key, alerts):
-    """Define a function for mitigating alerts"""
+def alert_start(alert):
+    """Define a function for getting the
+    start time of an alert as a datetime
 
-    mitigations = []
-    # Create a POST body for each mitigation to make
-    for alert in alerts:
-        attributes = extract_mitigation_attr(alert)
-        post = {
-			"data": {
-				"attributes": attributes,
-				"alert": {
+    """
+
+    return datetime.fromisoformat(
+		alert['attributes']['start_time'].replace('Z', '+00:00'))
+
+
+def start_mitigation(leader, key, alert):
+    """Define a function for starting the
+    mitigation for one alert
+
+    Returns a dict with the alert ID, the
+    mitigation name, whether it was started,
+    and the seconds from the start of the alert
+    to the start of the mitigation
+
+    """
+
+    attributes = extract_mitigation_attr(alert)
+    post = {
+		"data": {
+			"attributes": attributes,
+			"alert": {
+				"data": {
+					"id": alert['id'],
+					"type": "alert"
+				}
+			},
+			"relationships": {
+				"tms_group": {
 					"data": {
-						"id": alert['id'],
-						"type": "alert"
-					}
-				},
-				"relationships": {
-					"tms_group": {
-						"data": {
-							"id": "3",
-							"type": "tms_group"
-						}
+						"id": "3",
+						"type": "tms_group"
 					}
 				}
 			}
 		}
-    mitigations.append(post)
+	}
 
     MIT_URI = '/api/sp/mitigations/'
     URL = "https://" + leader + MIT_URI
-    # POST mitigations for each POST body created
-    for mitigation in mitigations:
+    try:
         api_response = api_request(URL,
 								   key,
-								   json.dumps(mitigation))
+								   json.dumps(post))
+    except requests.exceptions.RequestException as error:
+        print("Could not reach the leader: {}".format(error), file=stderr)
+        api_response = []
+    mitigated_at = datetime.now(timezone.utc)
+
+    return {
+		'alert_id': alert['id'],
+		'name': attributes['name'],
+		'started': len(api_response) > 0,
+		'mitigated_at': mitigated_at,
+		'latency': (mitigated_at - alert_start(alert)).total_seconds()
+	}
+
+
+def mitigate(leader, key, alerts, workers=MITIGATION_WORKERS):
+    """Define a function for mitigating alerts
+
+    The mitigations are POSTed at the same time,
+    up to workers at once, so the last one doesn't
+    wait for all of the others
+
+    Returns a list with the result from
+    start_mitigation() for each alert
+
+    """
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(
+			lambda alert: start_mitigation(leader, key, alert), alerts))
 
-		# Handle any API responses
-        if len(api_response) > 0:
-            print("{} started"
-				  .format(mitigation['data']['attributes']['name']))
+    # Handle any API responses
+    for result in results:
+        if result['started']:
+            print("{} started {:.1f} seconds after the alert"
+				  .format(result['name'], result['latency']))
         else:
             print("Could not start mitigation: {}"
-				  .format(mitigation['data']['attributes']['name']))
+				  .format(result['name']))
+
+    latencies = [result['latency'] for result in results
+				 if result['started']]
+    if latencies:
+        print("{} of {} mitigation(s) started; alert to mitigation "
+			  "latency: average {:.1f}s, worst {:.1f}s"
+			  .format(len(latencies), len(results),
+					  sum(latencies) / len(latencies), max(latencies)))
+
+    return results
+
+
+def load_state(filename):
+    """Define a function for reading the
+    watermark and the mitigated alerts
+
+    """
+
+    if not os.path.exists(filename):
+        return {'watermark': None, 'mitigated': {}}
+    with open(filename) as state_file:
+        return json.load(state_file)
+
+
+def save_state(state, filename):
+    """Define a function for writing the
+    watermark and the mitigated alerts
+
+    """
+
+    with open(filename + '.tmp', 'w') as state_file:
+        json.dump(state, state_file, indent=1)
+    os.rename(filename + '.tmp', filename)
+
+
+def run_once(leader, key, pushdown, match):
+    """Define a function for mitigating the
+    alerts from the last LOOKBACK once
+
+    """
+
+    timeframe = datetime.now() - LOOKBACK
+    alerts = get_alerts(leader, key, timeframe, pushdown)
+    if alerts is None:
+        print("Could not get the alerts")
+    elif len(alerts) > 0:
+        print("Alerts retrieved. Filtering on configured ruleset")
+        target_alerts = apply_rules(alerts, match)
+
+        if len(target_alerts) > 0:
+            print("Mitigating alerts")
+            mitigate(leader, key, target_alerts)
+            print("Done")
+    else:
+        print("No alerts were found in the requested period")
+
+
+def run_daemon(leader, key, pushdown, match, interval, state_file):
+    """Define a function for polling for
+    alerts and mitigating them until stopped
+
+    Each poll only asks for alerts that started after
+    the watermark, which is kept in the state file
+    along with the IDs of the alerts that have been
+    mitigated, so no alert is mitigated twice even
+    across restarts.  The watermark stays LOOKBACK
+    behind now, so alerts whose importance or other
+    attributes change to match the rules within
+    LOOKBACK of their start are still mitigated.  A
+    poll that fails is logged and the next poll
+    starts from the same watermark
+
+    """
+
+    state = load_state(state_file)
+    while True:
+        poll_start = time.time()
+        try:
+            poll(leader, key, pushdown, match, state)
+            save_state(state, state_file)
+        except (requests.exceptions.RequestException, ValueError,
+				KeyError, OSError) as error:
+            print("Poll failed: {}".format(error), file=stderr)
+
+        time.sleep(max(0, interval - (time.time() - poll_start)))
+
+
+def poll(leader, key, pushdown, match, state):
+    """Define a function for mitigating the new
+    alerts after the watermark once and moving
+    the watermark up
+
+    """
+
+    if state['watermark'] is None:
+        watermark = datetime.now(timezone.utc) - LOOKBACK
+    else:
+        watermark = datetime.fromisoformat(state['watermark'])
+
+    alerts = get_alerts(leader, key, watermark, pushdown)
+    if alerts is None:
+        return
+    # the leader only returns alerts after the watermark, but check that
+    # here too, since mitigated alerts before it have been forgotten
+    new_alerts = [alert for alert in apply_rules(alerts, match)
+				  if alert['id'] not in state['mitigated'] and
+				  alert_start(alert) > watermark]
+    starts = {alert['id']: alert_start(alert) for alert in new_alerts}
+    failed = []
+    for result in mitigate(leader, key, new_alerts):
+        if not result['started']:
+            failed.append(starts[result['alert_id']])
+            continue
+        state['mitigated'][result['alert_id']] = {
+				'start_time': starts[result['alert_id']].isoformat(),
+				'mitigated_at': result['mitigated_at'].isoformat(),
+				'latency': result['latency']
+			}
+
+    # Move the watermark up to LOOKBACK before now, so alerts that are
+    # escalated later are still seen (the mitigated alerts keep them
+    # from being mitigated twice), but not past an alert whose
+    # mitigation couldn't be started, so it is tried again.  Forget the
+    # mitigated alerts that started before it; they can't be returned
+    # again
+    candidate = datetime.now(timezone.utc) - LOOKBACK
+    if failed:
+        candidate = min(candidate, min(failed) - WATERMARK_OVERLAP)
+    watermark = max(watermark, candidate)
+    state['watermark'] = watermark.isoformat()
+    state['mitigated'] = {
+			alert_id: mitigated
+			for alert_id, mitigated in state['mitigated'].items()
+			if datetime.fromisoformat(mitigated['start_time']) >
+			watermark}
+
+
+def parse_cmdline_args():
+    """Parse the command line options and set some useful defaults"""
+    parser = argparse.ArgumentParser(
+		description='Start mitigations for alerts that match rules',
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+		'-r', '--rules',
+		default=RULES_FILE,
+		dest='rules',
+		help='JSON or YAML file with the mitigation rules')
+    parser.add_argument(
+		'-d', '--daemon',
+		action='store_true',
+		dest='daemon',
+		help='Keep polling for new alerts instead of running once')
+    parser.add_argument(
+		'-i', '--interval',
+		type=float,
+		default=POLL_INTERVAL,
+		dest='interval',
+		help='Seconds between polls in daemon mode')
+    parser.add_argument(
+		'-s', '--state_file',
+		default=STATE_FILE,
+		dest='state_file',
+		help='File holding the watermark and mitigated alerts in '
+			 'daemon mode')
+    return parser.parse_args()
+
 
 #####################
 # Start the program #
 #####################
-SP_LEADER = slenv.leader
-API_KEY = slenv.apitoken
-
-TIMEFRAME = datetime.now() - timedelta(minutes=15)
-
-print("Starting auto-mitigation script")
-alerts = get_alerts(SP_LEADER, API_KEY, TIMEFRAME)
-if len(alerts) > 0:
-    print("Alerts retrieved. Filtering on configured ruleset")
-    target_alerts = apply_rules(alerts)
-
-    if len(target_alerts) > 0:
-        print("Mitigating alerts")
-        mitigate(SP_LEADER, API_KEY, target_alerts)
-        print("Done")
-else:
-    print("No alerts were found in the requested period")
+if __name__ == '__main__':
+    SP_LEADER = slenv.leader
+    API_KEY = slenv.apitoken
+
+    args = parse_cmdline_args()
+
+    print("Starting auto-mitigation script")
+    PUSHDOWN, MATCH = compile_rules(load_rules(args.rules))
+    if args.daemon:
+        run_daemon(SP_LEADER, API_KEY, PUSHDOWN, MATCH, args.interval,
+				   args.state_file)
+    else:
+        run_once(SP_LEADER, API_KEY, PUSHDOWN, MATCH)
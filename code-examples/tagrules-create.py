@@ -1,18 +1,35 @@
-#!/usr/bin/env python2.7
+#!/usr/bin/env python3
 from __future__ import print_function
 import requests
 import json
+import socket
+import struct
 import sys
-from copy import deepcopy
-from itertools import cycle
-from datetime import date
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import cycle, islice
+from datetime import date, datetime
+from ipaddress import ip_network
+from time import sleep
 from dateutil.relativedelta import relativedelta
+from dateutil.tz import tzlocal, tzutc
+import insight_topn
+
+# The number of tag rules sent in each bulk request
+BULK_CHUNK_SIZE = 500
+# The most bulk requests sent at the same time
+BULK_WORKERS = 4
+# How many times to try sending each bulk request
+BULK_RETRIES = 3
+# Responses that mean the leader didn't apply a bulk request, so it can be
+# sent again; a POST that may have been applied is never sent again, since
+# that would create its tag rules twice
+RETRY_STATUSES = (requests.codes.too_many_requests,
+                  requests.codes.service_unavailable)
 
 
 def get_yesterdays_top_talkers(leader, apikey, number=2):
 
     yesterdays_top_talkers = []
-    url = 'https://{}/api/sp/insight/topn'.format(leader)
     # Query template for Source IPv4 Addresses
     query = {
         "limit": 3,
@@ -36,46 +53,73 @@ def get_yesterdays_top_talkers(leader, apikey, number=2):
     # set the size of the query
     query['limit'] = number
 
-    # set the time range of the query with a hard-coded "yesterday"
+    # set the time range of the query with a hard-coded "yesterday", in
+    # local time with its offset
     today = date.today()
-    yesterday_start = today + relativedelta(days=-1,
-                                            hour=0)
-    yesterday_end = today + relativedelta(days=-1,
-                                          hour=23,
-                                          minute=59,
-                                          second=59)
+    yesterday_start = (today + relativedelta(days=-1,
+                                             hour=0)).replace(
+                                                 tzinfo=tzlocal())
+    yesterday_end = (today + relativedelta(days=-1,
+                                           hour=23,
+                                           minute=59,
+                                           second=59)).replace(
+                                               tzinfo=tzlocal())
     query['start'] = yesterday_start.isoformat()
     query['end'] = yesterday_end.isoformat()
 
-    # post the query to the SL/Insight REST API
-    results = requests.post(
-        url,
-        headers={'X-Arbux-APIToken':
-                 apikey,
-                 'Content-Type':
-                 'application/vnd.api+json'},
-        json=query,
-        verify="./certfile")
-
-    if results.status_code != requests.codes.ok:
-        print("API query for yesterdays top talkers failed: [{}] {}".format(
-            results.status_code, results.reason),
-              file=sys.stdout)
-        sys.exit(1)
-    results = results.json()
+    # post the query to the SL/Insight REST API; yesterday is over, so
+    # insight_topn keeps the results and running this again today doesn't
+    # query Insight again
+    results = insight_topn.post_topn(leader, apikey, query)
 
     # Extract the IP addresses from the results
-    for top_talker in results['data']:
+    for top_talker in results:
         ipaddress = top_talker['Source_IPv4_Address'].split('/')[0]
         yesterdays_top_talkers.append(ipaddress)
 
     return yesterdays_top_talkers
 
 
-def create_tag_rules(leader, apikey, ipaddrs):
-    url = 'https://{}/api/sp/insight/tagrules/'.format(leader)
+def collapse_to_cidrs(ipaddrs):
     #
-    # Create some fake incident data and a tagrules template for it
+    # Find the fewest CIDR blocks that cover exactly these IPv4 addresses
+    # (which may themselves be CIDR blocks): turn them into sorted integer
+    # ranges, join ranges that touch or overlap, and cut each range into the
+    # largest aligned blocks that fit in it
+    #
+    ranges = []
+    for ipaddr in ipaddrs:
+        address, _, length = ipaddr.partition('/')
+        length = int(length or 32)
+        first = struct.unpack('!I', socket.inet_aton(address))[0]
+        first &= (0xffffffff << (32 - length)) & 0xffffffff
+        ranges.append((first, first + (1 << (32 - length)) - 1))
+    ranges.sort()
+
+    merged = []
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+
+    cidrs = []
+    for first, last in merged:
+        while first <= last:
+            # the biggest block that starts at `first` and fits in the range
+            size = (first & -first) or (1 << 32)
+            while size > last - first + 1:
+                size >>= 1
+            cidrs.append("{}/{}".format(
+                socket.inet_ntoa(struct.pack('!I', first)),
+                33 - size.bit_length()))
+            first += size
+    return cidrs
+
+
+def make_tag_rules(ipaddrs, aggregate=False):
+    #
+    # Create some fake incident data for the tag rules
     #
     today = date.today()
     yesterday_start = today + relativedelta(days=-1, hour=0)
@@ -88,65 +132,288 @@ def create_tag_rules(leader, apikey, ipaddrs):
     fake_incidents = cycle(
         [("12345", "{}".format(yesterday_start.isoformat())),
          ("54321", "{}".format(yesterday_start.isoformat()))])
-    ott_incident_template = {
-        "data": {
+    valid_until = "{}".format(a_week_from_today)
+
+    tagged = ((ipaddr, next(fake_incidents)) for ipaddr in ipaddrs)
+
+    #
+    # When aggregating, group the addresses by the incident they are tagged
+    # with and replace each group with the fewest CIDR blocks that cover it,
+    # so Insight has fewer tag rules to evaluate for each flow
+    #
+    if aggregate:
+        groups = {}
+        for ipaddr, incident in tagged:
+            groups.setdefault(incident, []).append(ipaddr)
+        tagged = ((cidr, incident)
+                  for incident, group in sorted(groups.items())
+                  for cidr in collapse_to_cidrs(group))
+
+    #
+    # Yield one tagrule (Over-the-Top, ott) at a time; each is a new dict,
+    # so there is no template to copy
+    #
+    for ipaddr, incident in tagged:
+        yield {
             "attributes": {
-                "valid_from": "",
-                "valid_until": "",
+                "valid_from": incident[1],
+                "valid_until": valid_until,
                 "tags": {
-                    "Incident": ""
+                    "Incident": incident[0]
                     },
                 "filter_criteria": {
-                    "Source_IPv4_Address": ""
+                    "Source_IPv4_Address": ipaddr
                 }
             }
         }
-    }
 
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def send_tag_rule_chunk(leader, apikey, chunk_num, tag_rules, method):
     #
-    # create a bulk tagrules (Over-the-Top, ott) posting body
+    # POST (or PATCH) one chunk of tag rules in a bulk request, trying again
+    # (up to BULK_RETRIES times) if it fails; only this chunk is sent again.
+    # A 4xx response is never tried again.  A PATCH only sets the validity,
+    # so sending it twice is harmless and it is tried again after any
+    # other failure, but a POST is only tried again when the leader can't
+    # have applied it: the connection was never made or the leader said it
+    # was too busy
     #
-    bulk_ott = []
-    for ipaddr in ipaddrs:
-        incident = next(fake_incidents)
-        ott = deepcopy(ott_incident_template)
-        ott['data']['attributes']['valid_from'] = incident[1]
-        ott['data']['attributes']['tags']['Incident'] = incident[0]
-        ott['data']['attributes']['valid_until'] = "{}".format(
-            a_week_from_today)
-        ott['data']['attributes']['filter_criteria']['Source_IPv4_Address'] = (
-            ipaddr)
-        bulk_ott.append(ott['data'])
-    bulk_ott = {'data': bulk_ott}
+    url = 'https://{}/api/sp/insight/tagrules/'.format(leader)
     headers = {'X-Arbux-APIToken': apikey,
                'Accept': '*/*; ext="spbulk"',
                'Content-Type':
                'application/vnd.api+json'}
-    results = requests.post(
-        url,
-        headers=headers,
-        data=json.dumps(bulk_ott),
-        verify="./certfile")
-    if (results.status_code is requests.codes.ok or
-        results.status_code is requests.codes.created or
-        results.status_code is requests.codes.accepted):
-
-        return results.json()
-    else:
-        print(results.status_code, results.reason)
-        return {'data': []}
+    body = json.dumps({'data': tag_rules})
+    chunk_start = datetime.now()
+    for attempt in range(1, BULK_RETRIES + 1):
+        try:
+            results = requests.request(
+                method,
+                url,
+                headers=headers,
+                data=body,
+                verify="./certfile")
+            if results.status_code in (requests.codes.ok,
+                                       requests.codes.created,
+                                       requests.codes.accepted):
+                return (chunk_num, results.json()['data'], attempt,
+                        (datetime.now() - chunk_start).total_seconds())
+            print("Chunk #{} attempt {} failed: {} {}".format(
+                chunk_num, attempt, results.status_code, results.reason))
+            retry = (results.status_code in RETRY_STATUSES or
+                     (method != 'POST' and results.status_code >= 500))
+        except requests.exceptions.ConnectTimeout as error:
+            print("Chunk #{} attempt {} failed: {}".format(
+                chunk_num, attempt, error))
+            retry = True
+        except requests.exceptions.RequestException as error:
+            print("Chunk #{} attempt {} failed: {}".format(
+                chunk_num, attempt, error))
+            retry = method != 'POST'
+        if not retry:
+            return (chunk_num, None, attempt,
+                    (datetime.now() - chunk_start).total_seconds())
+        if attempt < BULK_RETRIES:
+            sleep(2 ** attempt)
+    return (chunk_num, None, BULK_RETRIES,
+            (datetime.now() - chunk_start).total_seconds())
 
 
-def main(leader, apikey):
+def send_tag_rules(leader, apikey, tag_rules, method='POST',
+                   chunk_size=BULK_CHUNK_SIZE, workers=BULK_WORKERS):
+    #
+    # Split the tag rules into bulk requests of chunk_size rules and send
+    # up to `workers` of them at the same time; a chunk is only built when
+    # there is room for it, so no more than `workers` chunks of tag rules
+    # are in memory at once
+    #
+    sent = []
+
+    def finish(done):
+        for future in done:
+            chunk_num, tag_rules, attempts, seconds = future.result()
+            if tag_rules is None:
+                print("Chunk #{}: failed after {} attempt{} in {:.1f} "
+                      "seconds".format(chunk_num, attempts,
+                                       "" if attempts == 1 else "s",
+                                       seconds))
+                continue
+            print("Chunk #{}: {} tag rules {} in {:.1f} seconds "
+                  "({} attempt{})".format(chunk_num, len(tag_rules),
+                                          "created" if method == 'POST'
+                                          else "updated",
+                                          seconds, attempts,
+                                          "" if attempts == 1 else "s"))
+            sent.extend(tag_rules)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = set()
+        for chunk_num, chunk in enumerate(chunks(tag_rules, chunk_size)):
+            if len(running) >= workers:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                finish(done)
+            running.add(pool.submit(send_tag_rule_chunk, leader, apikey,
+                                    chunk_num, chunk, method))
+        finish(wait(running).done)
+    return {'data': sent}
+
+
+def create_tag_rules(leader, apikey, ipaddrs, aggregate=False):
+    return send_tag_rules(leader, apikey, make_tag_rules(ipaddrs, aggregate))
+
+
+def get_existing_tag_rules(leader, apikey):
+    #
+    # GET all of the tag rules, following the "next" links page by page
+    #
+    url = 'https://{}/api/sp/insight/tagrules/?perPage=100'.format(leader)
+    tag_rules = []
+    while url:
+        results = requests.get(
+            url,
+            headers={'X-Arbux-APIToken': apikey,
+                     'Content-Type': 'application/vnd.api+json'},
+            verify="./certfile")
+        if results.status_code != requests.codes.ok:
+            print("Could not get the existing tag rules: {} {}".format(
+                results.status_code, results.reason))
+            sys.exit(1)
+        results = results.json()
+        tag_rules.extend(results['data'])
+        url = results.get('links', {}).get('next')
+    return tag_rules
+
+
+def normalize_criterion(facet, value):
+    #
+    # 10.0.0.1 and 10.0.0.1/32 are the same address
+    #
+    if facet.endswith('_Address'):
+        return str(ip_network("{}".format(value), strict=False))
+    return "{}".format(value)
+
+
+def tag_rule_key(attributes):
+    #
+    # Two tag rules with the same filter criteria and tags are equivalent,
+    # whatever order their keys are in
+    #
+    criteria = sorted((facet, normalize_criterion(facet, value))
+                      for facet, value in
+                      attributes['filter_criteria'].items())
+    tags = sorted(attributes['tags'].items())
+    return json.dumps([criteria, tags])
+
+
+def validity(attributes):
+    #
+    # A tag rule may have no valid_from or valid_until; leave those as None
+    #
+    return tuple(insight_topn.to_utc(attributes[name])
+                 if attributes.get(name) else None
+                 for name in ('valid_from', 'valid_until'))
+
+
+def plan_tag_rule_sync(existing, desired):
+    #
+    # Work out which tag rules need to be created, which existing ones need
+    # their validity changed, and which existing ones should be expired
+    # because they aren't wanted any more (or duplicate another one).  Only
+    # existing tag rules with exactly the tags of one of the desired tag
+    # rules are looked at, so tag rules made by other integrations, or with
+    # no tags at all, are never expired
+    #
+    desired = list(desired)
+    managed = set(json.dumps(sorted(tag_rule['attributes']['tags'].items()))
+                  for tag_rule in desired)
+    now = datetime.now(tzutc())
+    current = {}
+    expires = []
+    for tag_rule in existing:
+        attributes = tag_rule['attributes']
+        tags = json.dumps(sorted(attributes.get('tags', {}).items()))
+        if tags not in managed:
+            continue
+        valid_until = validity(attributes)[1]
+        if valid_until is not None and valid_until <= now:
+            continue
+        key = tag_rule_key(attributes)
+        if key in current:
+            expires.append(tag_rule)
+        else:
+            current[key] = tag_rule
+
+    creates = []
+    updates = []
+    planned = set()
+    for tag_rule in desired:
+        key = tag_rule_key(tag_rule['attributes'])
+        if key in planned:
+            continue
+        planned.add(key)
+        old = current.pop(key, None)
+        if old is None:
+            creates.append(tag_rule)
+        elif validity(old['attributes']) != validity(tag_rule['attributes']):
+            updates.append({
+                'id': old['id'],
+                'attributes': {
+                    'valid_from': tag_rule['attributes']['valid_from'],
+                    'valid_until': tag_rule['attributes']['valid_until']
+                }
+            })
+    expires.extend(current.values())
+    expires = [{'id': tag_rule['id'],
+                'attributes': {'valid_until': now.isoformat()}}
+               for tag_rule in expires]
+    return creates, updates, expires
+
+
+def sync_tag_rules(leader, apikey, ipaddrs, aggregate=False):
+    #
+    # Only send the differences between the tag rules we want and the ones
+    # Insight already has
+    #
+    existing = get_existing_tag_rules(leader, apikey)
+    creates, updates, expires = plan_tag_rule_sync(
+        existing, make_tag_rules(ipaddrs, aggregate))
+    print("{} existing tag rules: {} to create, {} to update, "
+          "{} to expire".format(len(existing), len(creates), len(updates),
+                                len(expires)))
+    changed = []
+    if creates:
+        changed.extend(send_tag_rules(leader, apikey, creates)['data'])
+    if updates or expires:
+        changed.extend(send_tag_rules(leader, apikey, updates + expires,
+                                      method='PATCH')['data'])
+    return {'data': changed}
+
+
+def main(leader, apikey, sync=False, aggregate=True):
     #
     # get N top talkers from whatever complete day was yesterday
     #
     yesterdays_top_talkers = get_yesterdays_top_talkers(leader, apikey, 4)
 
     #
-    # with those IP addresses, create some tag rules with fake incidents
+    # with those IP addresses, create some tag rules with fake incidents;
+    # when syncing, only the tag rules that don't already exist are created
+    # and the ones for these incidents that aren't wanted any more expire
     #
-    new_tag_rules = create_tag_rules(leader, apikey, yesterdays_top_talkers)
+    if sync:
+        new_tag_rules = sync_tag_rules(leader, apikey,
+                                       yesterdays_top_talkers, aggregate)
+    else:
+        new_tag_rules = create_tag_rules(leader, apikey,
+                                         yesterdays_top_talkers, aggregate)
 
     #
     # Print out a table of the new tagrules
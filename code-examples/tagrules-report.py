@@ -1,10 +1,10 @@
-#!/usr/bin/env python2.7
+#!/usr/bin/env python3
 from __future__ import print_function
-import requests
 import json
-import sys
 from datetime import date
 from dateutil.relativedelta import relativedelta
+from dateutil.tz import tzlocal
+import insight_topn
 
 
 def make_query_totals_by_ipdest_tagrules(tagrules):
@@ -29,56 +29,61 @@ def make_query_totals_by_ipdest_tagrules(tagrules):
     query['groupby'] = tagrules
 
     #
-    # Set the query time range to the last 4 days
+    # Set the query time range to the last 4 days, ending at midnight
+    # tonight so that each day is a whole day; the times carry the local
+    # offset so Insight and the cache agree on when they are
     #
     today = date.today()
-    three_days_ago_start = today + relativedelta(
+    three_days_ago_start = (today + relativedelta(
         days=-3,
-        hour=0)
-    yesterday_end = today + relativedelta(
-        hour=23,
-        minute=59,
-        second=59)
+        hour=0)).replace(tzinfo=tzlocal())
+    today_end = (today + relativedelta(
+        days=+1,
+        hour=0)).replace(tzinfo=tzlocal())
 
     query['start'] = "{}".format(three_days_ago_start.isoformat())
-    query['end'] = "{}".format(yesterday_end.isoformat())
+    query['end'] = "{}".format(today_end.isoformat())
 
     return query
 
 
 def get_insight_data(leader, apikey, query):
-    url = 'https://{}/api/sp/insight/topn'.format(leader)
-    results = requests.post(
-        url,
-        headers={'X-Arbux-APIToken':
-                 apikey,
-                 'Content-Type':
-                 'application/vnd.api+json'},
-        json=query,
-        verify="./certfile")
-
-    if results.status_code != requests.codes.ok:
-        print("Insight query for tagged data failed: [{}] {}".format(
-            results.status_code, results.reason),
-              file=sys.stdout)
-        sys.exit(1)
-
-    return results.json()
+    #
+    # insight_topn caches the results, so running the same report again
+    # for time that has already passed doesn't query Insight again
+    #
+    return {'data': insight_topn.post_topn(leader, apikey, query)}
 
 
-def main(leader, apikey, tagrules):
+def main(leader, apikey, tagrules, by_day=False):
 
     query = make_query_totals_by_ipdest_tagrules(tagrules)
-    data = get_insight_data(leader, apikey, query)
+    if by_day:
+        #
+        # Query each day at the same time and combine the daily averages,
+        # weighted by how much of the time range each day covers, ranked
+        # by incoming traffic.  Days that are over are cached by
+        # insight_topn, so only today is queried again on the next run.
+        # This is an approximation of the four-day top 11: a row marked
+        # with "*" was missing from the top of some day, so its traffic
+        # is only a lower bound
+        #
+        rows, _ = insight_topn.fan_out_topn(leader, apikey, query,
+                                            split='day',
+                                            value='in')
+        data = {'data': rows}
+    else:
+        data = get_insight_data(leader, apikey, query)
 
     print("{:>6}  {:>15}  {:>15}  {:>15}".format(
         "Inc.#", "Dest IP Addr", "Src IP Addr", "In Traf (bps)"))
     for thing in data['data']:
-        print("{:>6}  {:>15}  {:>15}  {:>15.2f}".format(
+        print("{:>6}  {:>15}  {:>15}  {:>15.2f}{}".format(
             thing['Incident'],
             thing['Destination_IPv4_Address'],
             thing['Source_IPv4_Address'],
-            thing['bps']['average']['in']))
+            thing['bps']['average']['in'],
+            "*" if thing.get('partial_slices') else ""))
 
 
 if __name__ == '__main__':